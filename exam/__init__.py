@@ -1,10 +1,17 @@
 import csv
+import os
+import pickle
+import tempfile
 import xml
+from array import array
 from dataclasses import dataclass
 import xml.etree.ElementTree as xml
 from pathlib import Path
 from io import StringIO
-from markdown import markdown
+from hashlib import sha256
+from functools import lru_cache
+from markdown import Markdown
+import threading
 
 
 DIR_ROOT = Path(__file__).parent.parent
@@ -12,29 +19,69 @@ DEFAULT_QUESTIONS_FILE = DIR_ROOT / "static" / "questions.csv"
 
 
 class IdGenerator:
-    def __init__(self):
+    """Assigns IDs of the form `<category>-<n>`, counting questions per category, and skipping the IDs already `taken`.
+
+    Each loader or store uses its own generator: IDs only depend on the order in which questions are presented to it.
+    """
+
+    def __init__(self, taken=()):
         self.__categories = dict()
+        self.__taken = set(taken)
 
     def id_for(self, category):
-        if category not in self.__categories:
-            self.__categories[category] = 1
-        else:
-            self.__categories[category] += 1
-        return f"{category}-{self.__categories[category]}"
+        while True:
+            self.__categories[category] = self.__categories.get(category, 0) + 1
+            id = f"{category}-{self.__categories[category]}"
+            if id not in self.__taken:
+                self.__taken.add(id)
+                return id
+
+
+def digest(*parts) -> str:
+    """Return a stable hexadecimal hash of the given values, via their string representation."""
+    hasher = sha256()
+    for part in parts:
+        hasher.update(str(part).encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
 
+_MARKDOWN = Markdown()
+_MARKDOWN_LOCK = threading.Lock()
 
-DEFAULT_ID_GENERATOR = IdGenerator()
 
+@lru_cache(maxsize=4096)
+def markdown(text: str) -> str:
+    """Render `text` as HTML, via a shared Markdown converter, caching the most recently rendered texts."""
+    with _MARKDOWN_LOCK:
+        return _MARKDOWN.reset().convert(text)
 
-@dataclass(unsafe_hash=True)
+
+_CATEGORIES: dict[str, 'Category'] = dict()
+
+
+@dataclass(frozen=True, slots=True, init=False)
 class Category:
+    """Category of questions, named after its (space-less) name.
+
+    Categories are interned: there is exactly one (immutable) instance per name.
+    """
+
     name: str
 
-    def __post_init__(self):
-        self.name = self.name.strip().replace(" ", "")
+    def __new__(cls, name: str):
+        name = name.strip().replace(" ", "")
+        if (category := _CATEGORIES.get(name)) is None:
+            category = object.__new__(cls)
+            object.__setattr__(category, "name", name)
+            category = _CATEGORIES.setdefault(name, category)
+        return category
+
+    def __reduce__(self):
+        return Category, (self.name,)
 
     def copy(self):
-        return Category(self.name)
+        return self
 
     def to_xml(self, root: xml.Element):
         if root is None:
@@ -50,34 +97,30 @@ class Category:
         return root
 
 
-@dataclass(unsafe_hash=True)
+@dataclass(unsafe_hash=True, slots=True)
 class Question:
     category: Category = Category("Default")
     text: str = ""
     type: str = "essay"
     weight: float = 1.0
     max_lines: int = 15
+    # ID of the question, or None to have it assigned by the store the question is added to.
     id: str = None
 
     def __post_init__(self):
         if not isinstance(self.category, Category):
             self.category = Category(self.category)
-        if self.id is None:
-            self.id = DEFAULT_ID_GENERATOR.id_for(self.category.name)
         self.weight = float(self.weight)
         self.max_lines = int(self.max_lines)
 
     def copy(self):
-        return Question(
-            category=self.category.copy(),
-            text=self.text,
-            type=self.type,
-            weight=self.weight,
-            max_lines=self.max_lines,
-            id=self.id,
-        )
+        """Return a copy of this question, sharing all the immutable fields: only the weight is meant to be changed."""
+        question = object.__new__(type(self))
+        question.category, question.text, question.type = self.category, self.text, self.type
+        question.weight, question.max_lines, question.id = self.weight, self.max_lines, self.id
+        return question
 
-    def to_xml(self, root: xml.Element):
+    def to_xml(self, root: xml.Element, html: str = None):
         if root is None:
             root = xml.Element("question")
         else:
@@ -87,7 +130,7 @@ class Question:
         xml.SubElement(name, "text").text = self.id
         questiontext = xml.SubElement(root, "questiontext")
         questiontext.set("format", "html")
-        xml.SubElement(questiontext, "text").text = markdown(self.text)
+        xml.SubElement(questiontext, "text").text = markdown(self.text) if html is None else html
         xml.SubElement(root, "defaultgrade").text = str(float(self.weight))
         xml.SubElement(root, "penalty").text = "0"
         xml.SubElement(root, "hidden").text = "0"
@@ -99,17 +142,137 @@ class Question:
         return root
     
 
-def load_questions_from_csv(file_path):
+def load_questions_from_csv(file_path, id_generator: IdGenerator = None):
+    id_generator = id_generator or IdGenerator()
     with open(file_path, newline='') as csvfile:
         reader = csv.DictReader(csvfile, delimiter=",")
         for row in reader:
+            category = Category(row["Category"])
             yield Question(
-                category=row["Category"],
+                category=category,
                 text=row["Question"],
                 weight=row["Weight"],
+                id=id_generator.id_for(category.name),
             )
 
 
+class QuestionBank:
+    """Column-oriented view of the questions in a CSV file: one list or array per column, rather than one object per row.
+
+    Columns are saved in a binary snapshot (by default in `DIR_ROOT`, out of the published `static` folder), which is loaded
+    instead of the CSV file on later runs, as long as the CSV file is unchanged (same modification time and size, or else
+    same content hash).
+    Question IDs are assigned in file order, per category, as in `load_questions_from_csv`.
+    """
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, categories: list[str], category_codes: array, texts: list[str], weights: array, ids: list[str]):
+        # Distinct category names, in order of first appearance.
+        self.categories = categories
+        # Index in `categories` of the category of each question.
+        self.category_codes = category_codes
+        self.texts = texts
+        self.weights = weights
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return self.questions()
+
+    def questions(self):
+        categories = [Category(name) for name in self.categories]
+        for code, text, weight, id in zip(self.category_codes, self.texts, self.weights, self.ids):
+            yield Question(category=categories[code], text=text, weight=weight, id=id)
+
+    @classmethod
+    def from_csv(cls, file_path: Path | str) -> 'QuestionBank':
+        categories, codes, category_codes, texts, weights, ids = [], {}, array("I"), [], array("d"), []
+        id_generator = IdGenerator()
+        with open(file_path, newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=",")
+            header = next(reader, [])
+            i_category, i_text, i_weight = header.index("Category"), header.index("Question"), header.index("Weight")
+            for row in reader:
+                if not row:
+                    continue
+                name = Category(row[i_category]).name
+                if name not in codes:
+                    codes[name] = len(categories)
+                    categories.append(name)
+                category_codes.append(codes[name])
+                texts.append(row[i_text])
+                weights.append(float(row[i_weight]))
+                ids.append(id_generator.id_for(name))
+        return cls(categories, category_codes, texts, weights, ids)
+
+    @staticmethod
+    def snapshot_file(file_path: Path | str, snapshot_dir: Path | str = None) -> Path:
+        """Snapshot of the CSV file `file_path` in `snapshot_dir`, named after the file and (a hash of) its location."""
+        file_path = Path(file_path).resolve()
+        return Path(snapshot_dir or DIR_ROOT) / f"{file_path.stem}-{digest(file_path)[:12]}.snapshot"
+
+    @staticmethod
+    def __file_hash(file_path: Path) -> str:
+        with open(file_path, "rb") as f:
+            return sha256(f.read()).hexdigest()
+
+    @classmethod
+    def __load_snapshot(cls, file_path: Path, snapshot_file: Path, stat: os.stat_result):
+        try:
+            with open(snapshot_file, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            print(f"# error loading snapshot {snapshot_file}: {e}")
+            return None, None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != cls.SNAPSHOT_VERSION:
+            return None, None
+        if (snapshot["mtime_ns"], snapshot["size"]) == (stat.st_mtime_ns, stat.st_size):
+            return snapshot, None
+        file_hash = cls.__file_hash(file_path)
+        return (snapshot if snapshot["hash"] == file_hash else None), file_hash
+
+    @classmethod
+    def __save_snapshot(cls, snapshot_file: Path, stat: os.stat_result, file_hash: str, columns: dict):
+        snapshot = dict(version=cls.SNAPSHOT_VERSION, mtime_ns=stat.st_mtime_ns, size=stat.st_size, hash=file_hash, **columns)
+        try:
+            fd, temp_file = tempfile.mkstemp(dir=snapshot_file.parent, prefix=snapshot_file.name, suffix=".tmp")
+        except OSError as e:
+            print(f"# cannot write snapshot {snapshot_file}: {e}")
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, snapshot_file)
+        except BaseException:
+            Path(temp_file).unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def load(cls, file_path: Path | str = DEFAULT_QUESTIONS_FILE, snapshot: bool = True, snapshot_dir: Path | str = None) -> 'QuestionBank':
+        """Load the questions in the CSV file `file_path`, via its snapshot in `snapshot_dir` if it is up to date
+        (and `snapshot` is set)."""
+        file_path = Path(file_path)
+        if not snapshot:
+            return cls.from_csv(file_path)
+        stat = file_path.stat()
+        snapshot_file = cls.snapshot_file(file_path, snapshot_dir)
+        data, file_hash = cls.__load_snapshot(file_path, snapshot_file, stat)
+        columns = ("categories", "category_codes", "texts", "weights", "ids")
+        if data is not None:
+            if file_hash is not None:
+                # same content, different modification time: refresh the snapshot metadata
+                cls.__save_snapshot(snapshot_file, stat, file_hash, {c: data[c] for c in columns})
+            return cls(**{c: data[c] for c in columns})
+        bank = cls.from_csv(file_path)
+        cls.__save_snapshot(snapshot_file, stat, file_hash or cls.__file_hash(file_path), {c: getattr(bank, c) for c in columns})
+        return bank
+
+
 def group_by_category(questions):
     questions_by_category = dict()
     for question in questions:
@@ -118,26 +281,51 @@ def group_by_category(questions):
 
 
 class QuestionsStore:
+    """Collection of questions, grouped by category.
+
+    Sorted views and weights are computed once, at construction time, and weights are kept up to date
+    when changed via the `total_weight` setter: weights of questions should not be changed otherwise.
+    Questions lacking an ID are assigned one by the store, per category, in the order they are given.
+    """
+
     def __init__(self, questions=DEFAULT_QUESTIONS_FILE):
         if isinstance(questions, Path) or isinstance(questions, str):
-            questions = load_questions_from_csv(questions)
-        questions = [q.copy() for q in questions]
+            questions = list(QuestionBank.load(questions))
+        else:
+            questions = [q.copy() for q in questions]
+            id_generator = IdGenerator(q.id for q in questions if q.id is not None)
+            for question in questions:
+                if question.id is None:
+                    question.id = id_generator.id_for(question.category.name)
         self.__questions_by_category = group_by_category(questions)
         self.__questions_by_id = {q.id: q for question_list in self.__questions_by_category.values() for q in question_list}
         self.__categories = tuple(sorted(self.__questions_by_category.keys(), key=lambda x: x.name))
+        self.__questions = tuple(sorted(self.__questions_by_id.values(), key=lambda x: x.id))
+        self.__sorted_questions_by_category = {
+            category: tuple(sorted(question_list, key=lambda x: x.id))
+            for category, question_list in self.__questions_by_category.items()
+        }
+        self.__update_weights()
+
+    def __update_weights(self):
+        self.__category_weights = {
+            category: sum(q.weight for q in question_list)
+            for category, question_list in self.__questions_by_category.items()
+        }
+        self.__total_weight = sum(q.weight for q in self.__questions_by_id.values())
 
     @property
     def categories(self):
-        return sorted(self.__categories, key=lambda x: x.name)
+        return self.__categories
     
     @property
     def questions(self):
-        return sorted(self.__questions_by_id.values(), key=lambda x: x.id)
+        return self.__questions
     
     def category(self, category):
         if not isinstance(category, Category):
             category = Category(category)
-        if category not in self.__categories:
+        if category not in self.__questions_by_category:
             raise KeyError(f"Category {category} not found")
         return category
     
@@ -148,21 +336,18 @@ class QuestionsStore:
     
     def questions_in_category(self, category):
         category = self.category(category)
-        return sorted(self.__questions_by_category.get(category, []), key=lambda x: x.id)
+        return self.__sorted_questions_by_category[category]
     
     def category_size(self, category):
         category = self.category(category)
-        return len(self.__questions_by_category.get(category, []))
+        return len(self.__sorted_questions_by_category[category])
     
     def category_weight(self, category):
         category = self.category(category)
-        return sum(q.weight for q in self.__questions_by_category.get(category, []))
+        return self.__category_weights[category]
     
     def __len__(self):
-        return len(self.questions)
-    
-    def __total_weight(self):
-        return sum(q.weight for q in self.__questions_by_id.values())
+        return len(self.__questions_by_id)
     
     def sample(self, id: str, *others: str) -> 'QuestionsStore':
         ids = [id] + list(others)
@@ -171,28 +356,47 @@ class QuestionsStore:
     
     @property
     def total_weight(self):
-        return self.__total_weight()
+        return self.__total_weight
     
     @total_weight.setter
     def total_weight(self, value):
-        old_weight = self.__total_weight()
+        old_weight = self.__total_weight
         if value == old_weight:
             return
         factor = value / old_weight
-        for question in self.questions:
+        for question in self.__questions:
             question.weight *= factor
+        self.__update_weights()
     
-    def to_xml(self, rootname="quiz", white_list=None, black_list=None):
-        quiz = xml.Element(rootname)
+    def __xml_elements(self, white_list=None, black_list=None, html: dict[str, str] = None):
         for category in self.categories:
             if white_list is not None and category not in white_list:
                 continue
             if black_list is not None and category in black_list:
                 continue
-            category.to_xml(quiz)
+            yield category.to_xml(None)
             for question in self.questions_in_category(category):
-                question.to_xml(quiz)
+                yield question.to_xml(None, html.get(question.text) if html else None)
+
+    def to_xml(self, rootname="quiz", white_list=None, black_list=None, html: dict[str, str] = None):
+        quiz = xml.Element(rootname)
+        quiz.extend(self.__xml_elements(white_list, black_list, html))
         return xml.ElementTree(quiz)
+
+    def write_xml(self, file, rootname="quiz", white_list=None, black_list=None, html: dict[str, str] = None):
+        """Write the same document of `to_xml(...).write(file, encoding="unicode", xml_declaration=True)`, one element at a time.
+
+        Question texts are rendered as HTML via `markdown`, unless they are found in the `html` dictionary.
+        """
+        # this is the declaration ElementTree writes for encoding="unicode"
+        file.write(f"<?xml version='1.0' encoding='{getattr(file, 'encoding', None) or 'utf-8'}'?>\n")
+        empty = True
+        for element in self.__xml_elements(white_list, black_list, html):
+            if empty:
+                file.write(f"<{rootname}>")
+                empty = False
+            file.write(xml.tostring(element, encoding="unicode"))
+        file.write(f"<{rootname} />" if empty else f"</{rootname}>")
     
     def __str__(self):
         result = StringIO()
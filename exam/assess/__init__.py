@@ -1,13 +1,16 @@
-from exam import QuestionsStore, Question, DIR_ROOT
-from exam.openai import AIOracle
+from exam import QuestionsStore, Question, DIR_ROOT, digest
+from exam.openai import AIOracle, Metrics, llm_client
 from exam.solution import Answer, load_cache as load_answer
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from langchain_core.exceptions import OutputParserException
 from enum import Enum
-from yaml import safe_dump, safe_load
+from exam.assess.cache import AssessmentCache, YamlAssessmentCache, SqliteAssessmentCache, CacheKey, import_yaml, export_yaml
+from exam.assess.responses import Responses, open_responses
 from dataclasses import dataclass
 import re
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future
 import sys
 import os
 
@@ -23,18 +26,20 @@ ALL_QUESTIONS = QuestionsStore()
 PATTERN_QUESTION_FOLDER = re.compile(r"^Q\d+\s+-\s+(\w+-\d+)$")
 FILE_TEMPLATE = DIR_ROOT / "exam" / "assess" / "prompt-template.txt"
 TEMPLATE = FILE_TEMPLATE.read_text(encoding="utf-8")
+FILE_TEMPLATE_BATCH = DIR_ROOT / "exam" / "assess" / "prompt-template-batch.txt"
+TEMPLATE_BATCH = FILE_TEMPLATE_BATCH.read_text(encoding="utf-8")
+MOTIVATION_BLANK = "No answer was given."
 
 
-def _load_exam(exam: Path | str | list[str] | QuestionsStore) -> QuestionsStore:
+def _load_exam(exam: Path | str | list[str] | QuestionsStore | Responses) -> QuestionsStore:
     if isinstance(exam, str):
         exam = Path(exam)
     if isinstance(exam, Path):
-        questions = [d.name for d in exam.glob("Q* - *") if d.is_dir()]
-        exam = []
-        for question in questions:
-            match = PATTERN_QUESTION_FOLDER.match(question)
-            if match:
-                exam.append(match.group(1))
+        responses = open_responses(exam, PATTERN_QUESTION_FOLDER)
+        responses.close()
+        exam = responses
+    if isinstance(exam, Responses):
+        exam = exam.question_ids
     if isinstance(exam, list):
         if exam:
             exam = ALL_QUESTIONS.sample(*exam)
@@ -43,7 +48,7 @@ def _load_exam(exam: Path | str | list[str] | QuestionsStore) -> QuestionsStore:
     if isinstance(exam, QuestionsStore):
         return exam
     else:
-        raise TypeError("Exam must be a Path, str, list of question IDs, or QuestionsStore instance")
+        raise TypeError("Exam must be a Path, str, list of question IDs, Responses, or QuestionsStore instance")
 
 
 class FeatureType(str, Enum):
@@ -98,6 +103,14 @@ class FeatureAssessment(BaseModel):
     motivation: str = Field(description="Explanation of why the feature is present or not")
 
 
+class IndexedFeatureAssessment(FeatureAssessment):
+    index: int = Field(description="Number of the feature being assessed, as in the list of features")
+
+
+class FeaturesAssessment(BaseModel):
+    assessments: list[IndexedFeatureAssessment] = Field(description="Assessment of each feature, one item per feature")
+
+
 @dataclass
 class AnswerAssessment:
     # The student's answer to the question.
@@ -156,75 +169,117 @@ class TestAssessment:
             for question, answer in question_answers.items():
                 if per_question is None:
                     print(f"  Question: {question.text}", file=file)
-                print(f"  Answer:\n\t{answer.answer.replace('\n', '\n\t')}", file=file)
+                print(f"  Answer:\n\t{(answer.answer or '<no answer>').replace('\n', '\n\t')}", file=file)
                 print("  Assessments:", file=file)
                 for feature, assessment in answer.assessment.items():
                     print(f"    - [{'ok' if assessment.satisfied else 'KO'}] {feature.type.name}: {feature.description}", file=file)
                     print(f"        * {assessment.motivation.replace('\n', '\n          ')}", file=file)
 
 
+def normalize_answer(answer: str | None) -> str:
+    """Key grouping answers which only differ in whitespace or case: empty for missing or blank answers."""
+    return " ".join(answer.split()).casefold() if answer else ""
+
+
 def first(iterable):
     """Return the first item of an iterable or None if it's empty."""
     return next(iter(iterable), None)
 
 
 class Assessor(AIOracle):
-    def __init__(self, exam_dir_by_questions: Path, model_name: str = None, model_provider: str = None):
-        super().__init__(model_name, model_provider, FeatureAssessment)
-        self.__root = Path(exam_dir_by_questions)
-        self.__exam: QuestionsStore = _load_exam(exam_dir_by_questions)
+    """Assesses the answers in a Moodle "responses by question" export: either an extracted directory, or the ZIP archive itself.
+
+    Assessments are cached in `cache`, by default in YAML files next to the answers, or in a SQLite file next to the archive.
+    """
+
+    def __init__(self, exam_dir_by_questions: Path, model_name: str = None, model_provider: str = None, batched: bool = False,
+                 cache: AssessmentCache = None, metrics: Metrics = None):
+        super().__init__(model_name, model_provider, FeatureAssessment, metrics)
+        self.__batch_llm = llm_client(self.model_name, self.model_provider, FeaturesAssessment)[0] if batched else None
+        self.__responses = open_responses(exam_dir_by_questions, PATTERN_QUESTION_FOLDER)
+        if cache is None:
+            default_cache_file = self.__responses.default_cache_file
+            cache = SqliteAssessmentCache(default_cache_file) if default_cache_file else YamlAssessmentCache()
+        self.__cache = cache
+        self.__template_hash = digest(TEMPLATE, TEMPLATE_BATCH)
+        self.__exam: QuestionsStore = _load_exam(self.__responses)
         self.__answers: dict[str, Answer] = {}
         for question in self.__exam.questions:
-            if (cached_answer := load_answer(question)):
+            # a stale reference answer is still the rubric the answers are assessed against
+            cached_answer = load_answer(question, allow_stale=True)
+            self.metrics.record_cache("solutions", cached_answer is not None, question.id)
+            if cached_answer:
                 self.__answers[question.id] = cached_answer
             else:
                 raise ValueError(f"Cached answer for question {question.id} not found")
 
-    def __iterate_over_answers(self, on_question_over: callable = None):
+    @property
+    def template_hash(self) -> str:
+        return self.__template_hash
+
+    @property
+    def feature_hashes(self) -> dict[tuple[str, int], str]:
+        """Hash of each feature of the reference answers, by question ID and feature index, as in `CacheKey.feature_hash`."""
+        return {(question_id, index): digest(feature.type.name, feature.description)
+                for question_id, answer in self.__answers.items() for index, feature in enumerate_features(answer)}
+
+    @property
+    def cache(self) -> AssessmentCache:
+        return self.__cache
+
+    def close(self):
+        self.__responses.close()
+        self.__cache.close()
+
+    def __iterate_over_groups(self, on_question_over: callable = None, max_workers: int = 1):
+        """Yield `(question, target, key, members)` for each group of answers to a question sharing the same normalized `key`,
+        where members are `(code, name, answer, dir)` tuples, in order of student folder.
+
+        The answers to each question are read in bulk, with up to `max_workers` threads.
+        """
         for question in self.__exam.questions:
             target = self.__answers.get(question.id)
-            for dir in self.__root.glob(f"Q* - {question.id}/*"):
-                if dir.is_dir():
-                    code, name = dir.name.split(" - ")[:2]
-                    attempt_file = first(dir.glob("Attempt*_textresponse"))
-                    answer = attempt_file.read_text(encoding="utf-8") if attempt_file else None
-                    yield (code, name, question, target, answer, dir)
+            groups: dict[str, list[tuple[str, str, str, Path]]] = {}
+            responses = self.__responses.responses(question.id)
+            for response, answer in zip(responses, self.__responses.read_many(responses, max_workers)):
+                groups.setdefault(normalize_answer(answer), []).append((response.student_code, response.student_name, answer, response.dir))
+            for key, members in groups.items():
+                yield question, target, key, members
             if on_question_over:
                 on_question_over(question)
 
-    def __save_cache(self, dir: Path, feature: Feature, assessment: FeatureAssessment, index: int):
-        if not dir:
-            return
-        cache_file = dir / f"feature_{index}_{feature.type.name}.yml"
+    def __cache_key(self, code: str, question: Question, feature: Feature, index: int, answer: str, dir: Path, batched: bool = False) -> CacheKey:
+        """Key of the assessment of a feature, hashing the inputs of the (batched, if `batched`) prompt producing it:
+        assessments produced by the other prompt are fresh as well."""
+        input_hashes = [digest(template, question.text, feature.type.name, feature.description, answer, self.model_name, self.model_provider)
+                        for template in ((TEMPLATE_BATCH, TEMPLATE) if batched else (TEMPLATE, TEMPLATE_BATCH))]
+        return CacheKey(question.id, code, index, feature.type.name, feature.description, self.__template_hash, self.model_name,
+                        input_hashes[0], dir, tuple(input_hashes[1:]))
+
+    def __save_cache(self, key: CacheKey, assessment: FeatureAssessment):
         cache_data = assessment.model_dump()
-        cache_data["feature"] = feature.description
-        cache_data["feature_type"] = feature.type.name
-        with cache_file.open("w", encoding="utf-8") as f:
-            safe_dump(cache_data, f, sort_keys=True, allow_unicode=True)
-        print(f"# saved assessment to {cache_file}")
-
-    def __load_cache(self, dir: Path, feature: Feature, index: int) -> FeatureAssessment | None:
-        if not dir:
+        cache_data["feature"] = key.feature
+        cache_data["feature_type"] = key.feature_type
+        self.__cache.save(key, cache_data)
+
+    def __load_cache(self, key: CacheKey, record: bool = True) -> FeatureAssessment | None:
+        cached_data = self.__cache.load(key)
+        if record:
+            self.metrics.record_cache("assessments", cached_data is not None, key.question_id, key.feature_type)
+        if cached_data is None:
             return None
-        cache_file = dir / f"feature_{index}_{feature.type.name}.yml"
-        if not cache_file.exists():
+        try:
+            return FeatureAssessment(
+                motivation=cached_data.get("motivation"),
+                satisfied=cached_data.get("satisfied", False),
+            )
+        except Exception as e:
+            print(f"# error loading cached assessment for {key}: {e}")
             return None
-        with cache_file.open("r", encoding="utf-8") as f:
-            try:
-                cached_data = safe_load(f)
-                return FeatureAssessment(
-                    motivation=cached_data.get("motivation"),
-                    satisfied=cached_data.get("satisfied", False),
-                )
-            except Exception as e:
-                print(f"# error loading cached assessment from {cache_file}: {e}")
-                cache_file.unlink()
-
-
-    def __assess_feature(self, question: Question, feature: Feature, answer: str, dir: Path, index: int) -> FeatureAssessment:
-        cached_assessment = self.__load_cache(dir, feature, index)
-        if cached_assessment:
-            print(f"# loaded cached assessment for {feature.type.name} from {dir}")
+
+    def __assess_feature(self, key: CacheKey, question: Question, feature: Feature, answer: str, check_cache: bool = True) -> FeatureAssessment:
+        if check_cache and (cached_assessment := self.__load_cache(key)):
+            print(f"# loaded cached assessment for {key}")
             return cached_assessment
         prompt = TEMPLATE.format(
             class_name=FeatureAssessment.__name__,
@@ -235,18 +290,134 @@ class Assessor(AIOracle):
             feature=feature.description,
             answer=answer
         )
-        result = self.llm.invoke(prompt)
+        result = self.invoke(prompt, question_id=question.id, feature_type=feature.type.name)
         if not isinstance(result, FeatureAssessment):
             raise TypeError(f"Expected {FeatureAssessment.__name__}, got {type(result)}")
-        self.__save_cache(dir, feature, result, index)
+        self.__save_cache(key, result)
         return result
 
-    def assess_all(self):
+    def __assess_features_batch(self, code: str, question: Question, features: list[tuple[int, Feature]], answer: str, dir: Path) -> dict[int, FeatureAssessment]:
+        prompt = TEMPLATE_BATCH.format(
+            class_name=FeaturesAssessment.__name__,
+            question=question.text,
+            features="\n".join(f"    {index}. ({feature.type.value}, {feature.verb_ideal}) {feature.description}" for index, feature in features),
+            answer=answer
+        )
+        try:
+            result = self.invoke(prompt, llm=self.__batch_llm, question_id=question.id, feature_type="BATCH")
+        except (ValidationError, OutputParserException) as e:
+            print(f"# error in batched assessment for {question.id}/{code}, falling back to per-feature assessment: {e}")
+            return {}
+        if not isinstance(result, FeaturesAssessment):
+            print(f"# expected {FeaturesAssessment.__name__}, got {type(result)}: falling back to per-feature assessment")
+            return {}
+        features = dict(features)
+        results = {}
+        for item in result.assessments:
+            if item.index in features and item.index not in results:
+                results[item.index] = FeatureAssessment(satisfied=item.satisfied, motivation=item.motivation)
+                self.__save_cache(self.__cache_key(code, question, features[item.index], item.index, answer, dir, batched=True), results[item.index])
+        if len(results) < len(features):
+            print(f"# batched assessment for {question.id}/{code} covers {len(results)}/{len(features)} features, assessing the others one by one")
+        return results
+
+    def __assess_answer(self, code: str, question: Question, target: Answer, answer: str, dir: Path) -> list[tuple[Feature, FeatureAssessment]]:
+        features = list(enumerate_features(target))
+        results = {}
+        checked = self.__batch_llm is not None
+        if checked:
+            missing = []
+            for index, feature in features:
+                key = self.__cache_key(code, question, feature, index, answer, dir)
+                if (cached_assessment := self.__load_cache(key)):
+                    print(f"# loaded cached assessment for {key}")
+                    results[index] = cached_assessment
+                else:
+                    missing.append((index, feature))
+            if len(missing) > 1:
+                results.update(self.__assess_features_batch(code, question, missing, answer, dir))
+        for index, feature in features:
+            if index not in results:
+                key = self.__cache_key(code, question, feature, index, answer, dir)
+                results[index] = self.__assess_feature(key, question, feature, answer, check_cache=not checked)
+        return [(feature, results[index]) for index, feature in features]
+
+    def __calls_count(self, missing: int) -> int:
+        """How many LLM calls are needed to assess `missing` features of an answer."""
+        return 1 if self.__batch_llm is not None and missing > 1 else missing
+
+    def __missing_keys(self, code: str, question: Question, target: Answer, answer: str, dir: Path) -> list[tuple[int, CacheKey]]:
+        keys = ((index, self.__cache_key(code, question, feature, index, answer, dir)) for index, feature in enumerate_features(target))
+        return [(index, key) for index, key in keys if not self.__load_cache(key, record=False)]
+
+    @staticmethod
+    def __assess_blank(target: Answer) -> list[tuple[Feature, FeatureAssessment]]:
+        return [(feature, FeatureAssessment(satisfied=False, motivation=MOTIVATION_BLANK)) for _, feature in enumerate_features(target)]
+
+    def __assess_group(self, question: Question, target: Answer, members: list[tuple[str, str, str, Path]]) -> list[list[tuple[Feature, FeatureAssessment]]]:
+        """Assess the first of answers equal up to normalization, and fan its assessments out to the others, one list per member.
+
+        Members keep the assessments they have in cache already: only the missing ones are fanned out (and cached).
+        """
+        code, _, answer, dir = members[0]
+        results = self.__assess_answer(code, question, target, answer, dir)
+        members_results = [results]
+        saved = 0
+        for code, _, answer, dir in members[1:]:
+            member_results, missing = [], 0
+            for index, (feature, assessment) in enumerate(results):
+                key = self.__cache_key(code, question, feature, index, answer, dir)
+                if (cached_assessment := self.__load_cache(key, record=False)) is None:
+                    self.__save_cache(key, assessment)
+                    missing += 1
+                member_results.append((feature, cached_assessment or assessment))
+            members_results.append(member_results)
+            saved += self.__calls_count(missing)
+        self.metrics.record_savings(llm_calls_saved=saved)
+        return members_results
+
+    def plan(self, max_workers: int = 1) -> tuple[int, int, int, int]:
+        """Return how many features would be assessed by `assess_all`, how many are cached, how many LLM calls are needed,
+        and how many are saved by assessing blank answers without LLM, and duplicate answers once."""
+        features_count, cached_count, calls_count, saved_count = 0, 0, 0, 0
+        for question, target, key, members in self.__iterate_over_groups(max_workers=max_workers):
+            features = sum(1 for _ in enumerate_features(target))
+            for i, (code, name, answer, dir) in enumerate(members):
+                calls = self.__calls_count(missing := len(self.__missing_keys(code, question, target, answer, dir)))
+                features_count += features
+                cached_count += features - missing
+                if key and i == 0:
+                    calls_count += calls
+                else:
+                    saved_count += calls
+        return features_count, cached_count, calls_count, saved_count
+
+    def assess_all(self, max_workers: int = 1):
+        """Assess all answers, reading and grading up to `max_workers` answers concurrently (results are collected in order).
+
+        Answers equal up to whitespace and case are assessed once, and blank answers satisfy no feature, without LLM calls.
+        """
         assessments = TestAssessment()
-        def log(q):
+        pending = []
+        def collect(q):
+            for question, members, future in pending:
+                for (code, name, answer, _), results in zip(members, future.result()):
+                    for feature, assessment in results:
+                        assessments.add_assessment(code, name, question, answer, feature, assessment)
+            pending.clear()
             assessments.pretty_print(per_question=q, file=OUTPUT_FILE)
-        for code, name, question, target, answer, dir in self.__iterate_over_answers(on_question_over=log):
-            for index, feature in enumerate_features(target):
-                assessment = self.__assess_feature(question, feature, answer, dir, index)
-                assessments.add_assessment(code, name, question, answer, feature, assessment)
+        pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+        try:
+            for question, target, key, members in self.__iterate_over_groups(on_question_over=collect, max_workers=max_workers):
+                if key:
+                    future = pool.submit(self.__assess_group, question, target, members)
+                    self.metrics.record_savings(answers=len(members), distinct_answers=1, duplicate_answers=len(members) - 1)
+                else:
+                    future = Future()
+                    future.set_result([self.__assess_blank(target)] * len(members))
+                    saved = sum(self.__calls_count(len(self.__missing_keys(code, question, target, answer, dir))) for code, _, answer, dir in members)
+                    self.metrics.record_savings(answers=len(members), blank_answers=len(members), llm_calls_saved=saved)
+                pending.append((question, members, future))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
         return assessments
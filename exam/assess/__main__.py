@@ -1,15 +1,52 @@
 from exam.assess import *
+from exam.openai import METRICS, SCHEDULER
+import argparse
 import sys
+import zipfile
 
 
-path = sys.argv[1] if len(sys.argv) > 1 else None
-if not path:
-    raise ValueError("Please provide the path to the exam directory")
+parser = argparse.ArgumentParser(description="Assess students' answers via LLM")
+parser.add_argument("path", help="Path to the exam directory, or to the ZIP archive downloaded from Moodle (responses, by question)")
+parser.add_argument("--workers", "-j", type=int, default=1, help="Maximum amount of answers to be read and graded concurrently")
+parser.add_argument("--batched", "-b", action="store_true", help="Grade all features of an answer in a single LLM call")
+parser.add_argument("--cache-db", type=str, default=None, help="Store assessments in the given SQLite file, rather than in one YAML file per feature (default for ZIP archives: a SQLite file next to the archive)")
+parser.add_argument("--import-yaml", action="store_true", help="Import per-feature YAML assessments from the exam directory into the SQLite cache")
+parser.add_argument("--export-yaml", action="store_true", help="Export the SQLite cache as per-feature YAML assessments in the exam directory")
+parser.add_argument("--dry-run", action="store_true", help="Only report how many LLM calls the assessment would require")
+parser.add_argument("--metrics", type=str, default=None, help="Write a JSON summary of LLM calls and cache lookups to the given file")
+parser.add_argument("--trace", type=str, default=None, help="Append each LLM call and cache lookup, as a JSON line, to the given file")
+parser.add_argument("--rpm", type=float, default=None, help="Maximum amount of LLM requests per minute")
+parser.add_argument("--tpm", type=float, default=None, help="Maximum amount of LLM (prompt) tokens per minute")
+args = parser.parse_args()
+if args.rpm or args.tpm:
+    SCHEDULER.configure(args.rpm or SCHEDULER.requests_per_minute, args.tpm or SCHEDULER.tokens_per_minute)
+if (args.import_yaml or args.export_yaml) and not args.cache_db:
+    parser.error("--import-yaml and --export-yaml require --cache-db")
+if (args.import_yaml or args.export_yaml) and zipfile.is_zipfile(args.path):
+    parser.error("--import-yaml and --export-yaml require an extracted exam directory")
 
-assessor = Assessor(path)
-assessments = assessor.assess_all()
+cache = SqliteAssessmentCache(args.cache_db) if args.cache_db else None
+if args.trace:
+    METRICS.start_trace(args.trace)
+assessor = Assessor(args.path, batched=args.batched, cache=cache)
+if args.import_yaml:
+    count = import_yaml(args.path, cache, PATTERN_QUESTION_FOLDER, assessor.template_hash, assessor.model_name)
+    print(f"# imported {count} assessments into {cache.db_file}")
+if args.dry_run:
+    features_count, cached_count, calls_count, saved_count = assessor.plan(max_workers=args.workers)
+    print(f"# dry run: {features_count} features to assess, {cached_count} cached, {calls_count} LLM calls needed, "
+          f"{saved_count} saved on blank and duplicate answers")
+    sys.exit(0)
+assessments = assessor.assess_all(max_workers=args.workers)
+if args.export_yaml:
+    count = export_yaml(cache, args.path, PATTERN_QUESTION_FOLDER, assessor.template_hash, assessor.model_name, assessor.feature_hashes)
+    print(f"# exported {count} assessments from {cache.db_file}")
+assessor.close()
+METRICS.close()
+if args.metrics:
+    METRICS.write_summary(args.metrics)
+print(f"# metrics: {METRICS}")
 assessments.pretty_print(file=OUTPUT_FILE)
 if OUTPUT_FILE is not sys.stdout:
     assessments.pretty_print(file=sys.stdout)
     OUTPUT_FILE.close()
-
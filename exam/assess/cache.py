@@ -0,0 +1,240 @@
+from dataclasses import dataclass
+from exam import digest
+from pathlib import Path
+from yaml import safe_dump, safe_load
+import re
+import sqlite3
+import threading
+import time
+
+
+PATTERN_FEATURE_FILE = re.compile(r"^feature_(\d+)_(\w+)\.yml$")
+
+
+@dataclass(frozen=True)
+class CacheKey:
+    # ID of the question being answered.
+    question_id: str
+    # Code of the student who answered.
+    student_code: str
+    # Index of the feature within the reference answer.
+    index: int
+    # Name of the feature type (e.g. SHOULD).
+    feature_type: str
+    # Description of the feature.
+    feature: str
+    # Hash of the prompt templates the assessment may come from.
+    template_hash: str = ""
+    # Name of the model used for the assessment.
+    model_name: str = ""
+    # Hash of all the inputs of the assessment prompt: cached data computed from different inputs is stale.
+    input_hash: str = ""
+    # Directory of the student's answer, if any.
+    dir: Path = None
+    # Input hashes of the other prompts which may have produced the same assessment (e.g. the batched one), also fresh.
+    other_input_hashes: tuple[str, ...] = ()
+
+    def is_fresh(self, input_hash: str) -> bool:
+        return input_hash == self.input_hash or input_hash in self.other_input_hashes
+
+    @property
+    def feature_hash(self) -> str:
+        return digest(self.feature_type, self.feature)
+
+    @property
+    def file_name(self) -> str:
+        return f"feature_{self.index}_{self.feature_type}.yml"
+
+    def __str__(self):
+        return f"{self.feature_type} of {self.question_id}/{self.student_code}"
+
+
+class AssessmentCache:
+    """Storage for feature assessments, as dictionaries with (at least) `satisfied` and `motivation` keys.
+
+    Entries whose input hash differs from the one of the key are stale, and not loaded.
+    Entries lacking an input hash predate content addressing, and are loaded only if they assess the same feature.
+    """
+
+    def load(self, key: CacheKey) -> dict | None:
+        raise NotImplementedError
+
+    def save(self, key: CacheKey, data: dict):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class YamlAssessmentCache(AssessmentCache):
+    """One YAML file per feature, stored in the directory of the student's answer."""
+
+    def load(self, key: CacheKey) -> dict | None:
+        if not key.dir:
+            return None
+        cache_file = key.dir / key.file_name
+        if not cache_file.exists():
+            return None
+        with cache_file.open("r", encoding="utf-8") as f:
+            try:
+                data = safe_load(f)
+            except Exception as e:
+                print(f"# error loading cached assessment from {cache_file}: {e}")
+                data = None
+        if not isinstance(data, dict):
+            if data is not None:
+                print(f"# cached assessment in {cache_file} is not a mapping")
+            cache_file.unlink()
+            return None
+        if "input_hash" in data:
+            stale = not key.is_fresh(data["input_hash"])
+        else:
+            stale = data.get("feature") != key.feature or data.get("feature_type") != key.feature_type
+        if stale:
+            print(f"# cached assessment in {cache_file} is stale")
+            data = None
+        return data
+
+    def save(self, key: CacheKey, data: dict):
+        if not key.dir:
+            return
+        cache_file = key.dir / key.file_name
+        if key.input_hash:
+            data = dict(data, input_hash=key.input_hash)
+        with cache_file.open("w", encoding="utf-8") as f:
+            safe_dump(data, f, sort_keys=True, allow_unicode=True)
+        print(f"# saved assessment to {cache_file}")
+
+
+class SqliteAssessmentCache(AssessmentCache):
+    """All assessments in a single SQLite file (in WAL mode), indexed by the fields of `CacheKey`."""
+
+    def __init__(self, db_file: Path | str):
+        self.__db_file = Path(db_file)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(self.__db_file, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("""
+            CREATE TABLE IF NOT EXISTS assessments (
+                question_id TEXT NOT NULL,
+                student_code TEXT NOT NULL,
+                feature_index INTEGER NOT NULL,
+                feature_hash TEXT NOT NULL,
+                template_hash TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                feature_type TEXT NOT NULL,
+                feature TEXT NOT NULL,
+                satisfied INTEGER NOT NULL,
+                motivation TEXT NOT NULL,
+                input_hash TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (question_id, student_code, feature_index, feature_hash, template_hash, model_name)
+            )
+        """)
+        columns = {row[1] for row in self.__connection.execute("PRAGMA table_info(assessments)")}
+        if "input_hash" not in columns:
+            self.__connection.execute("ALTER TABLE assessments ADD COLUMN input_hash TEXT NOT NULL DEFAULT ''")
+        if "updated_at" not in columns:
+            self.__connection.execute("ALTER TABLE assessments ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        self.__connection.commit()
+
+    @property
+    def db_file(self) -> Path:
+        return self.__db_file
+
+    def load(self, key: CacheKey) -> dict | None:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT satisfied, motivation, input_hash FROM assessments WHERE question_id = ? AND student_code = ? "
+                "AND feature_index = ? AND feature_hash = ? AND template_hash = ? AND model_name = ?",
+                (key.question_id, key.student_code, key.index, key.feature_hash, key.template_hash, key.model_name),
+            ).fetchone()
+        if row is None:
+            return None
+        if row[2] and not key.is_fresh(row[2]):
+            print(f"# cached assessment for {key} is stale")
+            return None
+        return {"satisfied": bool(row[0]), "motivation": row[1], "feature": key.feature, "feature_type": key.feature_type}
+
+    def save(self, key: CacheKey, data: dict):
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO assessments (question_id, student_code, feature_index, feature_hash, template_hash, "
+                "model_name, feature_type, feature, satisfied, motivation, input_hash, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key.question_id, key.student_code, key.index, key.feature_hash, key.template_hash, key.model_name,
+                 key.feature_type, key.feature, int(bool(data.get("satisfied", False))), data.get("motivation") or "",
+                 key.input_hash or data.get("input_hash", ""), time.time()),
+            )
+            self.__connection.commit()
+
+    def entries(self):
+        """Iterate over all cached (key, data) pairs, sorted by question, student, feature index, and time of writing."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT question_id, student_code, feature_index, template_hash, model_name, feature_type, feature, "
+                "satisfied, motivation, input_hash FROM assessments ORDER BY question_id, student_code, feature_index, updated_at"
+            ).fetchall()
+        for question_id, student_code, index, template_hash, model_name, feature_type, feature, satisfied, motivation, input_hash in rows:
+            key = CacheKey(question_id, student_code, index, feature_type, feature, template_hash, model_name, input_hash)
+            yield key, {"satisfied": bool(satisfied), "motivation": motivation, "feature": feature, "feature_type": feature_type}
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+def _student_dirs(root: Path, pattern_question_folder: re.Pattern):
+    for question_dir in root.iterdir():
+        if not question_dir.is_dir() or not (match := pattern_question_folder.match(question_dir.name)):
+            continue
+        for student_dir in question_dir.iterdir():
+            if student_dir.is_dir():
+                yield match.group(1), student_dir.name.split(" - ")[0], student_dir
+
+
+def import_yaml(root: Path | str, cache: AssessmentCache, pattern_question_folder: re.Pattern, template_hash: str = "", model_name: str = "") -> int:
+    """Copy all per-directory YAML assessments found in the exam directory `root` into `cache`."""
+    count = 0
+    for question_id, student_code, student_dir in _student_dirs(Path(root), pattern_question_folder):
+        for file in student_dir.iterdir():
+            if not (match := PATTERN_FEATURE_FILE.match(file.name)):
+                continue
+            with file.open("r", encoding="utf-8") as f:
+                data = safe_load(f) or {}
+            if not isinstance(data, dict):
+                print(f"# cached assessment in {file} is not a mapping, skipping")
+                continue
+            key = CacheKey(question_id, student_code, int(match.group(1)), match.group(2),
+                           data.get("feature", ""), template_hash, model_name, data.get("input_hash", ""))
+            cache.save(key, data)
+            count += 1
+    return count
+
+
+def export_yaml(cache: SqliteAssessmentCache, root: Path | str, pattern_question_folder: re.Pattern, template_hash: str = "",
+                model_name: str = "", feature_hashes: dict[tuple[str, int], str] = None) -> int:
+    """Write the assessments in `cache` as per-directory YAML files, in the exam directory `root`.
+
+    Each feature file gets a single assessment: preferably the one of the current feature (as in `feature_hashes`,
+    by question ID and feature index), template and model, or else the most recently written one.
+    """
+    dirs = {(question_id, student_code): student_dir for question_id, student_code, student_dir in _student_dirs(Path(root), pattern_question_folder)}
+    feature_hashes = feature_hashes or {}
+    chosen: dict[tuple[str, str, int], tuple[tuple, CacheKey, dict]] = {}
+    for order, (key, data) in enumerate(cache.entries()):
+        rank = (key.feature_hash == feature_hashes.get((key.question_id, key.index)),
+                key.template_hash == template_hash, key.model_name == model_name, order)
+        slot = (key.question_id, key.student_code, key.index)
+        if slot not in chosen or rank > chosen[slot][0]:
+            chosen[slot] = (rank, key, data)
+    target = YamlAssessmentCache()
+    count = 0
+    for _, key, data in chosen.values():
+        if (dir := dirs.get((key.question_id, key.student_code))) is None:
+            print(f"# no directory for {key.question_id}/{key.student_code} in {root}, skipping")
+            continue
+        target.save(CacheKey(key.question_id, key.student_code, key.index, key.feature_type, key.feature, input_hash=key.input_hash, dir=dir), data)
+        count += 1
+    return count
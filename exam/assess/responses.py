@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from pathlib import Path
+import os
+import re
+import zipfile
+
+
+PATTERN_ATTEMPT_FILE = "Attempt*_textresponse"
+
+
+@dataclass(frozen=True)
+class Response:
+    # ID of the question being answered.
+    question_id: str
+    # Code of the student who answered.
+    student_code: str
+    # Name of the student who answered.
+    student_name: str
+    # Location of the student's folder, for messages (within the archive, if any).
+    location: str
+    # Directory of the student's answer on disk, or None if the answer is within an archive.
+    dir: Path = None
+    # Path (or archive entry) of the attempt file, or None if the student gave no text response.
+    attempt: str = None
+
+
+def _split_student_folder(folder_name: str) -> tuple[str, str] | None:
+    """Code and name of the student of a `<code> - <name>` folder, or None if the folder is not named so."""
+    parts = folder_name.split(" - ")
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[1]
+
+
+class Responses:
+    """Index of the students' responses in a Moodle "responses by question" export, built in a single pass.
+
+    Question folders are the ones matching `pattern_question_folder`, which captures the question ID.
+    """
+
+    def __init__(self, pattern_question_folder: re.Pattern):
+        self._pattern = pattern_question_folder
+        self._responses: dict[str, list[Response]] = {}
+
+    @property
+    def question_ids(self) -> list[str]:
+        return sorted(self._responses)
+
+    def responses(self, question_id: str) -> list[Response]:
+        """Responses to the given question, sorted by student folder."""
+        return self._responses.get(question_id, [])
+
+    def __len__(self):
+        return sum(len(responses) for responses in self._responses.values())
+
+    def read(self, response: Response) -> str | None:
+        raise NotImplementedError
+
+    def read_many(self, responses: list[Response], max_workers: int = 1) -> list[str | None]:
+        """Read the given responses in bulk, in order, with up to `max_workers` threads."""
+        if max_workers <= 1 or len(responses) <= 1:
+            return [self.read(response) for response in responses]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(self.read, responses))
+
+    @property
+    def default_cache_file(self) -> Path | None:
+        """Where assessments should be cached, if the folders of the students cannot host them."""
+        return None
+
+    def close(self):
+        pass
+
+
+class DirectoryResponses(Responses):
+    """Responses extracted on disk, as `<root>/Q* - <id>/<code> - <name>/Attempt*_textresponse` files."""
+
+    def __init__(self, root: Path | str, pattern_question_folder: re.Pattern):
+        super().__init__(pattern_question_folder)
+        self.__root = Path(root)
+        with os.scandir(self.__root) as question_entries:
+            for question_entry in question_entries:
+                if question_entry.is_dir() and (match := self._pattern.match(question_entry.name)):
+                    self._responses.setdefault(match.group(1), []).extend(self.__scan_question(match.group(1), question_entry.path))
+        for responses in self._responses.values():
+            responses.sort(key=lambda r: r.location)
+
+    def __scan_question(self, question_id: str, question_dir: str):
+        with os.scandir(question_dir) as student_entries:
+            for student_entry in student_entries:
+                if not student_entry.is_dir():
+                    continue
+                if (student := _split_student_folder(student_entry.name)) is None:
+                    continue
+                code, name = student
+                with os.scandir(student_entry.path) as files:
+                    attempts = sorted(f.path for f in files if f.is_file() and fnmatch(f.name, PATTERN_ATTEMPT_FILE))
+                yield Response(question_id, code, name, student_entry.path, Path(student_entry.path), attempts[0] if attempts else None)
+
+    def read(self, response: Response) -> str | None:
+        if response.attempt is None:
+            return None
+        with open(response.attempt, "r", encoding="utf-8") as f:
+            return f.read()
+
+
+class ZipResponses(Responses):
+    """Responses within the ZIP archive downloaded from Moodle, read lazily, without extracting the archive.
+
+    Question folders may be nested within a top-level folder of the archive.
+    """
+
+    def __init__(self, zip_file: Path | str, pattern_question_folder: re.Pattern):
+        super().__init__(pattern_question_folder)
+        self.__zip_file = Path(zip_file)
+        self.__archive = zipfile.ZipFile(self.__zip_file)
+        students: dict[tuple[str, str], list[str]] = {}
+        for entry in self.__archive.namelist():
+            parts = entry.rstrip("/").split("/")
+            for i, part in enumerate(parts[:-1]):
+                if (match := self._pattern.match(part)):
+                    # only folders are students: either explicit directory entries, or parents of other entries
+                    if len(parts) == i + 2 and not entry.endswith("/"):
+                        break
+                    if _split_student_folder(parts[i + 1]) is None:
+                        break
+                    attempts = students.setdefault((match.group(1), "/".join(parts[:i + 2])), [])
+                    if len(parts) == i + 3 and not entry.endswith("/") and fnmatch(parts[-1], PATTERN_ATTEMPT_FILE):
+                        attempts.append(entry)
+                    break
+        for (question_id, location), attempts in sorted(students.items(), key=lambda item: item[0][1]):
+            code, name = _split_student_folder(location.rsplit("/", 1)[-1])
+            attempt = min(attempts) if attempts else None
+            self._responses.setdefault(question_id, []).append(Response(question_id, code, name, location, None, attempt))
+
+    def read(self, response: Response) -> str | None:
+        if response.attempt is None:
+            return None
+        return self.__archive.read(response.attempt).decode("utf-8")
+
+    @property
+    def default_cache_file(self) -> Path:
+        return self.__zip_file.with_name(f"{self.__zip_file.stem}.assessments.db")
+
+    def close(self):
+        self.__archive.close()
+
+
+def open_responses(path: Path | str, pattern_question_folder: re.Pattern) -> Responses:
+    """Index the responses in `path`, which is either a directory or a ZIP archive."""
+    path = Path(path)
+    if path.is_file() and zipfile.is_zipfile(path):
+        return ZipResponses(path, pattern_question_folder)
+    return DirectoryResponses(path, pattern_question_folder)
@@ -0,0 +1,137 @@
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from exam import *
+
+
+def synthetic_questions(size: int, categories: int = 50, seed: int = 42):
+    """Generate `size` questions, spread over `categories` categories, with weights between 1 and 3."""
+    rng = random.Random(seed)
+    for i in range(size):
+        category = f"Category{i % categories}"
+        yield Question(
+            category=category,
+            text=f"Question number {i}, about *{category}*?",
+            weight=rng.randint(1, 3),
+            id=f"{category}-{i // categories + 1}",
+        )
+
+
+def timed(name: str, function: callable, repetitions: int = 1):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        result = function()
+    elapsed = (time.perf_counter() - start) / repetitions
+    print(f"# - {name}: {elapsed * 1000:.2f}ms")
+    return result
+
+
+def peak_memory(name: str, function: callable):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"# - {name}: {elapsed * 1000:.2f}ms, peak memory {peak / 2 ** 20:.1f}MiB")
+
+
+def retained_memory(name: str, function: callable):
+    tracemalloc.start()
+    result = function()
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    print(f"# - {name}: retained {current / 2 ** 20:.1f}MiB in {blocks} blocks, peak memory {peak / 2 ** 20:.1f}MiB")
+    return result
+
+
+def benchmark_memory(size: int, samples: int = 100, sample_size: int = 10):
+    print(f"# benchmark: memory of {size} synthetic questions")
+    questions = retained_memory("questions", lambda: list(synthetic_questions(size)))
+    store = retained_memory("QuestionsStore()", lambda: QuestionsStore(questions))
+    rng = random.Random(42)
+    ids = [[q.id for q in rng.sample(store.questions, sample_size)] for _ in range(samples)]
+    retained_memory(f"{samples} samples of {sample_size} questions", lambda: [store.sample(*s) for s in ids])
+
+
+def benchmark_xml(size: int):
+    print(f"# benchmark: Moodle XML export of {size} synthetic questions")
+    store = QuestionsStore(synthetic_questions(size))
+
+    def tree():
+        with open(os.devnull, "w", encoding="utf-8") as sink:
+            store.to_xml().write(sink, encoding="unicode", xml_declaration=True)
+
+    def stream():
+        with open(os.devnull, "w", encoding="utf-8") as sink:
+            store.write_xml(sink)
+
+    peak_memory("to_xml().write()", tree)
+    peak_memory("write_xml()", stream)
+
+
+def benchmark_store(size: int):
+    print(f"# benchmark: QuestionsStore with {size} synthetic questions")
+    questions = list(synthetic_questions(size))
+    store = timed("construction", lambda: QuestionsStore(questions))
+    timed("len()", lambda: len(store), repetitions=100)
+    timed("questions", lambda: store.questions, repetitions=100)
+    timed("questions_in_category() for all categories", lambda: [store.questions_in_category(c) for c in store.categories], repetitions=10)
+    timed("category_weight() for all categories", lambda: [store.category_weight(c) for c in store.categories], repetitions=10)
+    timed("total_weight", lambda: store.total_weight, repetitions=100)
+    timed("str()", lambda: str(store))
+
+
+def benchmark_loader(size: int):
+    print(f"# benchmark: loading a CSV file of {size} synthetic questions")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_file = Path(temp_dir) / "questions.csv"
+        with open(csv_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Category", "Question", "Weight"])
+            writer.writerows([q.category.name, q.text, q.weight] for q in synthetic_questions(size))
+        timed("load_questions_from_csv()", lambda: list(load_questions_from_csv(csv_file)))
+        timed("QuestionBank.load(), no snapshot", lambda: QuestionBank.load(csv_file, snapshot_dir=temp_dir))
+        timed("QuestionBank.load(), from snapshot", lambda: QuestionBank.load(csv_file, snapshot_dir=temp_dir), repetitions=10)
+        timed("QuestionsStore(), from snapshot", lambda: QuestionsStore(QuestionBank.load(csv_file, snapshot_dir=temp_dir)))
+
+
+def benchmark_test_generation(exams: int, total_weight: int, target_categories: int = 3):
+    import exam.test as etest
+    etest.VERBOSE = False
+    store = QuestionsStore()
+    targets = set(sorted(store.categories, key=store.category_weight, reverse=True)[:target_categories])
+    print(f"# benchmark: generation of {exams} tests of weight {total_weight} from {len(store)} questions, covering {len(targets)} categories")
+    for engine in etest.ENGINES:
+        start = time.perf_counter()
+        solutions = etest.TestGenerator(store, total_weight, targets, engine=engine).solutions
+        first, count = None, 0
+        for count, _ in enumerate(solutions, start=1):
+            first = first or time.perf_counter() - start
+            if count == exams:
+                break
+        elapsed = time.perf_counter() - start
+        print(f"# - {engine}: first test after {(first or elapsed) * 1000:.2f}ms, {count} tests after {elapsed * 1000:.2f}ms")
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks on synthetic question banks")
+    parser.add_argument("--questions", "-n", type=int, default=100_000, help="Amount of synthetic questions")
+    parser.add_argument("--exams", type=int, default=100, help="Amount of tests to be generated by each engine")
+    parser.add_argument("--total-weight", type=int, default=9, help="Total weight of the generated tests")
+    parser.add_argument("--xml-questions", type=int, default=5_000, help="Amount of synthetic questions to be exported as XML")
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_arg_parser().parse_args()
+    benchmark_store(args.questions)
+    benchmark_loader(args.questions)
+    benchmark_memory(args.questions)
+    benchmark_xml(args.xml_questions)
+    benchmark_test_generation(args.exams, args.total_weight)
@@ -0,0 +1,45 @@
+from exam import QuestionsStore, markdown
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import re
+
+
+PATTERN_ID_SEPARATOR = re.compile(r"[\s,]+")
+
+
+def parse_tests(lines) -> list[list[str]]:
+    """Parse one test per line, as question IDs separated by spaces or commas (blank lines and #-comments are skipped)."""
+    tests = []
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            tests.append([id for id in PATTERN_ID_SEPARATOR.split(line) if id])
+    return tests
+
+
+_HTML: dict[str, str] = {}
+
+
+def _initialize_worker(html: dict[str, str]):
+    global _HTML
+    _HTML = html
+
+
+def _write_test(path: Path, questions: list):
+    with open(path, "w", encoding="utf-8") as file:
+        QuestionsStore(questions).write_xml(file, html=_HTML)
+    return path
+
+
+def export_tests(tests: list[QuestionsStore], output_dir: Path | str, max_workers: int = None, prefix: str = "test") -> list[Path]:
+    """Write each test as a Moodle XML file in `output_dir`, in parallel worker processes.
+
+    Question texts are rendered as HTML once, in the calling process, and shared with all workers.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    html = {question.text: markdown(question.text) for test in tests for question in test.questions}
+    width = len(str(len(tests)))
+    paths = [output_dir / f"{prefix}-{index + 1:0{width}d}.xml" for index in range(len(tests))]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_worker, initargs=(html,)) as pool:
+        return list(pool.map(_write_test, paths, [list(test.questions) for test in tests]))
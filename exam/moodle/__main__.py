@@ -2,6 +2,7 @@ import argparse
 import sys
 
 from exam import *
+from exam.moodle import export_tests, parse_tests
 
 
 def parse_args():
@@ -58,14 +59,65 @@ def main():
 		metavar="CATEGORY",
 		help="Exclude the specified category. Repeat the flag to exclude multiple categories.",
 	)
+	parser.add_argument(
+		"--output",
+		"-o",
+		default=None,
+		metavar="FILE",
+		help="Write the XML to the specified file, rather than to the standard output.",
+	)
+	parser.add_argument(
+		"--tests",
+		default=None,
+		metavar="FILE",
+		help="Export one XML file per test listed in FILE ('-' for the standard input), one line of question IDs per test.",
+	)
+	parser.add_argument(
+		"--output-dir",
+		default=".",
+		metavar="DIR",
+		help="Directory where the XML files of --tests are written.",
+	)
+	parser.add_argument(
+		"--prefix",
+		default="test",
+		help="Prefix of the names of the XML files of --tests.",
+	)
+	parser.add_argument(
+		"--workers",
+		"-j",
+		type=int,
+		default=None,
+		help="Amount of worker processes exporting --tests (default: one per CPU).",
+	)
 
 	args = parser.parse_args()
 	questions = QuestionsStore(args.questions_file)
+
+	if args.tests:
+		if args.white_list or args.black_list or args.output:
+			parser.error("--tests cannot be combined with --white-list, --black-list, or --output")
+		if args.tests == "-":
+			ids = parse_tests(sys.stdin)
+		else:
+			with open(args.tests, encoding="utf-8") as file:
+				ids = parse_tests(file)
+		try:
+			tests = [questions.sample(*test) for test in ids]
+		except KeyError as error:
+			parser.error(f"--tests: {error}")
+		for path in export_tests(tests, args.output_dir, args.workers, args.prefix):
+			print(f"# written {path}", file=sys.stderr)
+		return
+
 	white_list = resolve_categories(parser, questions, args.white_list, "--white-list")
 	black_list = resolve_categories(parser, questions, args.black_list, "--black-list")
 
-	tree = questions.to_xml(white_list=white_list, black_list=black_list)
-	tree.write(sys.stdout, encoding="unicode", xml_declaration=True)
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as output:
+			questions.write_xml(output, white_list=white_list, black_list=black_list)
+	else:
+		questions.write_xml(sys.stdout, white_list=white_list, black_list=black_list)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import getpass
 import os
 from langchain.chat_models import init_chat_model
+from exam.openai.metrics import Metrics, METRICS, estimate_tokens
+from exam.openai.scheduler import RateLimitScheduler, SCHEDULER, INTERACTIVE, BULK
+from exam.openai.cassette import CassetteLLM, CassetteEmbeddings, CassetteMissError, cassette_mode, replay_latency
 
 
 KEY_OPENAI_API_KEY = "OPENAI_API_KEY"
@@ -17,21 +20,47 @@ def llm_client(model_name: str = None, model_provider: str = None, structured_ou
         model_name = "gpt-4o-mini"
     if not model_provider:
         model_provider = "openai"
+    mode = cassette_mode()
+    if mode == "replay":
+        return CassetteLLM(None, model_name, model_provider, structured_output, latency=replay_latency()), model_name, model_provider
     ensure_openai_api_key()
     llm = init_chat_model(model_name, model_provider=model_provider)
     if structured_output is not None:
         llm = llm.with_structured_output(structured_output)
+    if mode == "record":
+        llm = CassetteLLM(llm, model_name, model_provider, structured_output, mode=mode)
     return llm, model_name, model_provider
 
 
 class AIOracle:
-    def __init__(self, model_name: str = None, model_provider: str = None, structured_output: type = None):
+    def __init__(self, model_name: str = None, model_provider: str = None, structured_output: type = None, metrics: Metrics = None,
+                 scheduler: RateLimitScheduler = None, priority: int = BULK):
         self.__llm, self.__model_name, self.__model_provider = llm_client(model_name, model_provider, structured_output)
+        self.__metrics = metrics if metrics is not None else METRICS
+        self.__scheduler = scheduler if scheduler is not None else SCHEDULER
+        self.__priority = priority
 
     @property
     def llm(self):
         return self.__llm
 
+    @property
+    def metrics(self) -> Metrics:
+        return self.__metrics
+
+    @property
+    def scheduler(self) -> RateLimitScheduler:
+        return self.__scheduler
+
+    def invoke(self, prompt, llm=None, question_id: str = None, feature_type: str = None, attempt: int = 0, priority: int = None):
+        """Call `llm` (by default, `self.llm`) on `prompt`, recording the call in `self.metrics`.
+
+        Calls are admitted by `self.scheduler`, by `priority` (by default, the one of this oracle), and retried upon rate limits.
+        """
+        def call(retry: int):
+            return self.__metrics.invoke(llm or self.__llm, prompt, self.__model_name, question_id, feature_type, attempt + retry)
+        return self.__scheduler.call(call, estimate_tokens(prompt), self.__priority if priority is None else priority)
+
     @property
     def model_name(self):
         return self.__model_name
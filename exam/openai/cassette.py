@@ -0,0 +1,168 @@
+from exam import DIR_ROOT, digest
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from pathlib import Path
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+KEY_CASSETTE_MODE = "LLM_CASSETTE_MODE"
+KEY_CASSETTE_FILE = "LLM_CASSETTE_FILE"
+KEY_CASSETTE_LATENCY = "LLM_CASSETTE_LATENCY"
+DEFAULT_CASSETTE_FILE = DIR_ROOT / "cassettes.db"
+# live: call the provider; record: call the provider, and save requests and responses; replay: serve saved responses only.
+MODES = ("live", "record", "replay")
+
+
+def cassette_mode() -> str:
+    mode = os.environ.get(KEY_CASSETTE_MODE, "").strip().lower() or "live"
+    if mode not in MODES:
+        raise ValueError(f"Invalid {KEY_CASSETTE_MODE}: {mode}. Please use one of {', '.join(MODES)}.")
+    return mode
+
+
+def replay_latency() -> float:
+    """Seconds of latency to be injected in each replayed call."""
+    return float(os.environ.get(KEY_CASSETTE_LATENCY) or 0)
+
+
+class CassetteMissError(KeyError):
+    pass
+
+
+class CassetteStore:
+    """Requests and responses of LLM and embedding calls, in a single SQLite file, indexed by the hash of the request."""
+
+    def __init__(self, db_file: Path | str):
+        self.__db_file = Path(db_file)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(self.__db_file, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("""
+            CREATE TABLE IF NOT EXISTS cassette (
+                kind TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                request TEXT NOT NULL,
+                response TEXT NOT NULL,
+                PRIMARY KEY (kind, request_hash)
+            )
+        """)
+        self.__connection.commit()
+
+    @property
+    def db_file(self) -> Path:
+        return self.__db_file
+
+    def load(self, kind: str, request_hash: str) -> str | None:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT response FROM cassette WHERE kind = ? AND request_hash = ?", (kind, request_hash)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save(self, kind: str, request_hash: str, request: str, response: str):
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO cassette VALUES (?, ?, ?, ?)", (kind, request_hash, request, response))
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+_STORES: dict[Path, CassetteStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def cassette_store(db_file: Path | str = None) -> CassetteStore:
+    """The store in `db_file` (by default, the one named by the environment), shared by all the calls of this process."""
+    db_file = Path(db_file or os.environ.get(KEY_CASSETTE_FILE) or DEFAULT_CASSETTE_FILE).resolve()
+    with _STORES_LOCK:
+        if db_file not in _STORES:
+            _STORES[db_file] = CassetteStore(db_file)
+        return _STORES[db_file]
+
+
+def _prompt_text(prompt) -> str:
+    return prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+
+
+class CassetteLLM:
+    """Chat model (possibly with structured output) whose calls are recorded to, or replayed from, a `CassetteStore`.
+
+    In replay mode there is no underlying model: requests never recorded raise `CassetteMissError`.
+    """
+
+    def __init__(self, llm, model_name: str, model_provider: str, structured_output: type = None,
+                 store: CassetteStore = None, mode: str = "replay", latency: float = 0.0):
+        self.__llm = llm
+        self.__structured_output = structured_output
+        schema = json.dumps(structured_output.model_json_schema(), sort_keys=True) if structured_output is not None else ""
+        self.__request_prefix = (model_name, model_provider, schema)
+        self.__store = store if store is not None else cassette_store()
+        self.__mode = mode
+        self.__latency = latency
+
+    def __serialize(self, result) -> str:
+        if self.__structured_output is not None:
+            return result.model_dump_json()
+        return dumps(result)
+
+    def __deserialize(self, response: str):
+        if self.__structured_output is not None:
+            return self.__structured_output.model_validate_json(response)
+        return loads(response)
+
+    def invoke(self, prompt, config=None, **kwargs):
+        request = _prompt_text(prompt)
+        request_hash = digest(*self.__request_prefix, request)
+        if self.__mode == "replay":
+            response = self.__store.load("llm", request_hash)
+            if response is None:
+                raise CassetteMissError(f"No recorded response for this prompt in {self.__store.db_file}, "
+                                        f"please record it first with {KEY_CASSETTE_MODE}=record")
+            if self.__latency:
+                time.sleep(self.__latency)
+            return self.__deserialize(response)
+        result = self.__llm.invoke(prompt, config=config, **kwargs)
+        self.__store.save("llm", request_hash, request, self.__serialize(result))
+        return result
+
+
+class CassetteEmbeddings(Embeddings):
+    """Embeddings recorded to, or replayed from, a `CassetteStore`, text by text."""
+
+    def __init__(self, embeddings: Embeddings | None, model: str, store: CassetteStore = None, mode: str = "replay",
+                 latency: float = 0.0):
+        self.model = model
+        self.__embeddings = embeddings
+        self.__store = store if store is not None else cassette_store()
+        self.__mode = mode
+        self.__latency = latency
+
+    def __request_hash(self, text: str) -> str:
+        return digest(self.model, text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        texts = list(texts)
+        if self.__mode == "replay":
+            vectors = []
+            for text in texts:
+                response = self.__store.load("embedding", self.__request_hash(text))
+                if response is None:
+                    raise CassetteMissError(f"No recorded embedding of {text[:40]!r} in {self.__store.db_file}, "
+                                            f"please record it first with {KEY_CASSETTE_MODE}=record")
+                vectors.append(json.loads(response))
+            if self.__latency:
+                time.sleep(self.__latency)
+            return vectors
+        vectors = self.__embeddings.embed_documents(texts)
+        for text, vector in zip(texts, vectors):
+            self.__store.save("embedding", self.__request_hash(text), text, json.dumps(vector))
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
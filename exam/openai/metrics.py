@@ -0,0 +1,225 @@
+from dataclasses import dataclass, asdict
+from langchain_core.callbacks import BaseCallbackHandler
+from pathlib import Path
+import json
+import threading
+import time
+
+
+# USD per million of input and output tokens, for the models whose cost should be estimated.
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+@dataclass
+class Event:
+    # Either "llm" (a call to a model) or "cache" (a lookup in a cache).
+    kind: str
+    # Seconds since the epoch, at the end of the event.
+    timestamp: float
+    # ID of the question the event is about, if any.
+    question_id: str = None
+    # Name of the assessed feature type (e.g. SHOULD), or BATCH for batched assessments, if any.
+    feature_type: str = None
+    # Name of the model called.
+    model_name: str = None
+    # Duration of the call, in seconds.
+    latency: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Whether token counts are estimated from text lengths, as the model did not report them.
+    estimated: bool = False
+    # Attempt number of the call: 0 for the first attempt, more for retries.
+    attempt: int = 0
+    # Error message, for failed calls.
+    error: str = None
+    # Name of the cache looked up (e.g. solutions, assessments).
+    cache: str = None
+    # Whether the cache lookup was successful.
+    hit: bool = None
+
+
+def estimate_tokens(text) -> int:
+    return len(str(text)) // 4 + 1
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Percentile `p` (0-100) of the given sorted values, interpolating linearly between the closest ranks."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies), "mean": sum(latencies) / len(latencies) if latencies else 0.0}
+    summary.update({f"p{p}": percentile(latencies, p) for p in PERCENTILES})
+    summary["max"] = latencies[-1] if latencies else 0.0
+    return summary
+
+
+def cost(model_name: str, input_tokens: int, output_tokens: int) -> float | None:
+    if model_name not in PRICES:
+        return None
+    input_price, output_price = PRICES[model_name]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class UsageHandler(BaseCallbackHandler):
+    """Collects the token usage reported by the models called within a single `invoke`."""
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.reported = False
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    self.input_tokens += usage.get("input_tokens", 0)
+                    self.output_tokens += usage.get("output_tokens", 0)
+                    self.reported = True
+                    return
+        usage = (response.llm_output or {}).get("token_usage")
+        if usage:
+            self.input_tokens += usage.get("prompt_tokens", 0)
+            self.output_tokens += usage.get("completion_tokens", 0)
+            self.reported = True
+
+
+class Metrics:
+    """Thread-safe collector of LLM calls and cache lookups, which can also be traced as JSON lines while running."""
+
+    def __init__(self, trace_file: Path | str = None):
+        self.__lock = threading.Lock()
+        self.__events: list[Event] = []
+        self.__savings: dict[str, int] = {}
+        self.__trace = None
+        if trace_file:
+            self.start_trace(trace_file)
+
+    def start_trace(self, trace_file: Path | str):
+        with self.__lock:
+            if self.__trace is not None:
+                self.__trace.close()
+            self.__trace = open(trace_file, "a", encoding="utf-8")
+
+    def close(self):
+        with self.__lock:
+            if self.__trace is not None:
+                self.__trace.close()
+                self.__trace = None
+
+    def record(self, event: Event):
+        with self.__lock:
+            self.__events.append(event)
+            if self.__trace is not None:
+                self.__trace.write(json.dumps(asdict(event)) + "\n")
+                self.__trace.flush()
+
+    def record_savings(self, **counts: int):
+        """Add to the counters of work avoided (e.g. LLM calls not needed), which are reported as they are."""
+        with self.__lock:
+            for name, count in counts.items():
+                self.__savings[name] = self.__savings.get(name, 0) + count
+
+    @property
+    def savings(self) -> dict[str, int]:
+        with self.__lock:
+            return dict(self.__savings)
+
+    @property
+    def events(self) -> list[Event]:
+        with self.__lock:
+            return list(self.__events)
+
+    def record_cache(self, cache: str, hit: bool, question_id: str = None, feature_type: str = None):
+        self.record(Event("cache", time.time(), question_id, feature_type, cache=cache, hit=bool(hit)))
+
+    def invoke(self, llm, prompt, model_name: str = None, question_id: str = None, feature_type: str = None, attempt: int = 0):
+        """Call `llm.invoke(prompt)`, recording latency and token usage (estimated from text lengths, if not reported)."""
+        handler = UsageHandler()
+        event = Event("llm", 0.0, question_id, feature_type, model_name, attempt=attempt)
+        result = None
+        start = time.perf_counter()
+        try:
+            result = llm.invoke(prompt, config={"callbacks": [handler]})
+        except Exception as e:
+            event.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            event.latency = time.perf_counter() - start
+            event.timestamp = time.time()
+            if handler.reported:
+                event.input_tokens, event.output_tokens = handler.input_tokens, handler.output_tokens
+            else:
+                event.estimated = True
+                event.input_tokens = estimate_tokens(prompt)
+                # result is None if interrupted (e.g. by KeyboardInterrupt, which is not recorded as an error)
+                event.output_tokens = 0 if event.error or result is None else estimate_tokens(result.model_dump_json() if hasattr(result, "model_dump_json") else result)
+            self.record(event)
+        return result
+
+    @staticmethod
+    def __calls_summary(calls: list[Event]) -> dict:
+        input_tokens = sum(e.input_tokens for e in calls)
+        output_tokens = sum(e.output_tokens for e in calls)
+        costs = [cost(e.model_name, e.input_tokens, e.output_tokens) for e in calls]
+        return {
+            "calls": len(calls),
+            "errors": sum(1 for e in calls if e.error),
+            "retries": sum(1 for e in calls if e.attempt > 0),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "estimated_token_calls": sum(1 for e in calls if e.estimated),
+            "cost": sum(c for c in costs if c is not None) if any(c is not None for c in costs) else None,
+            "latency": latency_summary([e.latency for e in calls]),
+        }
+
+    def summary(self) -> dict:
+        events = self.events
+        calls = [e for e in events if e.kind == "llm"]
+        summary = self.__calls_summary(calls)
+        for group in ("question_id", "feature_type"):
+            grouped = {}
+            for e in calls:
+                if getattr(e, group) is not None:
+                    grouped.setdefault(getattr(e, group), []).append(e)
+            summary[f"by_{group.removesuffix('_id')}"] = {key: self.__calls_summary(grouped[key]) for key in sorted(grouped)}
+        caches = {}
+        for e in events:
+            if e.kind == "cache":
+                stats = caches.setdefault(e.cache, {"hits": 0, "misses": 0})
+                stats["hits" if e.hit else "misses"] += 1
+        for stats in caches.values():
+            stats["hit_rate"] = stats["hits"] / (stats["hits"] + stats["misses"])
+        summary["caches"] = caches
+        summary["savings"] = self.savings
+        return summary
+
+    def write_summary(self, file: Path | str):
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write("\n")
+
+    def __str__(self):
+        summary = self.summary()
+        caches = ", ".join(f"{name} {stats['hits']} hits/{stats['misses']} misses" for name, stats in summary["caches"].items())
+        return (f"{summary['calls']} LLM calls ({summary['errors']} failed, {summary['retries']} retries), "
+                f"{summary['input_tokens']} input + {summary['output_tokens']} output tokens, "
+                f"p50 latency {summary['latency']['p50']:.2f}s, p95 {summary['latency']['p95']:.2f}s"
+                + (f", caches: {caches}" if caches else "")
+                + "".join(f", {name.replace('_', ' ')}: {count}" for name, count in summary["savings"].items()))
+
+
+# Metrics of all the oracles which are not given their own.
+METRICS = Metrics()
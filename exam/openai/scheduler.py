@@ -0,0 +1,158 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+
+# Priorities of calls: lower values are served first.
+INTERACTIVE = 0
+BULK = 10
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Whether `error` signals that the provider is rate-limiting us (e.g. openai.RateLimitError, or HTTP 429)."""
+    if "RateLimit" in type(error).__name__:
+        return True
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status_code == 429
+
+
+def retry_after(error: Exception) -> float | None:
+    """Seconds to wait before retrying, as suggested by the provider via the Retry-After header, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Budget of `capacity` units per minute, refilled continuously."""
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.__available = self.capacity
+        self.__last = time.monotonic()
+
+    def __refill(self, now: float):
+        self.__available = min(self.capacity, self.__available + (now - self.__last) * self.capacity / 60)
+        self.__last = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (requests larger than the capacity only need a full bucket)."""
+        self.__refill(now)
+        missing = min(amount, self.capacity) - self.__available
+        return max(0.0, missing * 60 / self.capacity)
+
+    def consume(self, amount: float, now: float):
+        self.__refill(now)
+        self.__available -= min(amount, self.capacity)
+
+
+class RateLimitScheduler:
+    """Admits calls to a model within requests-per-minute and tokens-per-minute budgets, highest priority first.
+
+    When a call is rate-limited anyway, all calls are paused for an exponentially growing, jittered delay
+    (or the one suggested by the provider), and the call is retried, up to `max_retries` times.
+    Budgets can be None, for no limit.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.__condition = threading.Condition()
+        self.__waiting = []
+        self.__tickets = itertools.count()
+        self.__paused_until = 0.0
+        self.__rate_limits = 0
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        with self.__condition:
+            self.__requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.__tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+            self.__condition.notify_all()
+
+    @property
+    def requests_per_minute(self) -> float | None:
+        return self.__requests.capacity if self.__requests is not None else None
+
+    @property
+    def tokens_per_minute(self) -> float | None:
+        return self.__tokens.capacity if self.__tokens is not None else None
+
+    def __wait_time(self, tokens: int, now: float) -> float:
+        wait = self.__paused_until - now
+        if self.__requests is not None:
+            wait = max(wait, self.__requests.wait_time(1, now))
+        if self.__tokens is not None:
+            wait = max(wait, self.__tokens.wait_time(tokens, now))
+        return wait
+
+    def acquire(self, tokens: int = 0, priority: int = BULK):
+        """Block until a call estimated to use `tokens` tokens can be sent, after all waiting calls of higher priority."""
+        with self.__condition:
+            ticket = (priority, next(self.__tickets))
+            heapq.heappush(self.__waiting, ticket)
+            try:
+                while True:
+                    if self.__waiting[0] == ticket:
+                        now = time.monotonic()
+                        if (wait := self.__wait_time(tokens, now)) <= 0:
+                            if self.__requests is not None:
+                                self.__requests.consume(1, now)
+                            if self.__tokens is not None:
+                                self.__tokens.consume(tokens, now)
+                            return
+                        self.__condition.wait(wait)
+                    else:
+                        self.__condition.wait()
+            finally:
+                self.__waiting.remove(ticket)
+                heapq.heapify(self.__waiting)
+                self.__condition.notify_all()
+
+    def __backoff(self, error: Exception) -> float:
+        with self.__condition:
+            self.__rate_limits += 1
+            delay = retry_after(error)
+            if delay is None:
+                delay = min(self.max_delay, self.base_delay * 2 ** (self.__rate_limits - 1)) * (0.5 + random.random())
+            self.__paused_until = max(self.__paused_until, time.monotonic() + delay)
+            self.__condition.notify_all()
+            return delay
+
+    def __succeeded(self):
+        with self.__condition:
+            self.__rate_limits = 0
+
+    def call(self, function: callable, tokens: int = 0, priority: int = BULK):
+        """Call `function(attempt)` when allowed, retrying it upon rate-limit errors, and return its result."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                result = function(attempt)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.__backoff(e)
+                print(f"# rate limited (attempt {attempt + 1}/{self.max_retries + 1}), pausing calls for {delay:.1f}s")
+                continue
+            self.__succeeded()
+            return result
+
+
+def _budget(name: str) -> float | None:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+KEY_REQUESTS_PER_MINUTE = "LLM_REQUESTS_PER_MINUTE"
+KEY_TOKENS_PER_MINUTE = "LLM_TOKENS_PER_MINUTE"
+
+# Scheduler shared by all the oracles which are not given their own.
+SCHEDULER = RateLimitScheduler(_budget(KEY_REQUESTS_PER_MINUTE), _budget(KEY_TOKENS_PER_MINUTE))
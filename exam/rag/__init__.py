@@ -1,13 +1,27 @@
 from langchain_community.embeddings.openai import OpenAIEmbeddings
 from langchain_community.vectorstores import SQLiteVec
-from exam.openai import ensure_openai_api_key
-from exam import DIR_ROOT
+from langchain_community.vectorstores.sqlitevec import serialize_f32
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from exam.openai import ensure_openai_api_key, CassetteEmbeddings, cassette_mode, replay_latency
+from exam.rag.index import NumpyVectorIndex
+from exam import DIR_ROOT, digest
 from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass
+from array import array
+from pathlib import Path
+import json
 import re
+import sqlite3
+import threading
+import time
 
 
 DIR_CONTENT = DIR_ROOT / "content"
 FILE_DB = DIR_ROOT / "slides-rag.db"
+FILE_EMBEDDINGS_CACHE = DIR_ROOT / "embeddings-cache.db"
 MARKDOWN_FILES = list(DIR_CONTENT.glob("**/_index.md"))
 REGEX_SLIDE_DELIMITER = re.compile(r"^\s*(---|\+\+\+)")
 
@@ -22,6 +36,19 @@ class Slide(BaseModel):
     def lines_count(self):
         return self.content.count("\n") + 1 if self.content else 0
 
+    @property
+    def tokens_count(self):
+        # rough estimate, assuming ~4 characters per token
+        return len(self.content) // 4 + 1
+
+    @property
+    def metadata(self):
+        return {"source": self.source, "lines": self.lines, "index": self.index}
+
+    @property
+    def content_hash(self):
+        return digest(self.source, self.index, self.content)
+
 
 def all_slides(files = None):
     if files is None:
@@ -59,7 +86,6 @@ def all_slides(files = None):
 
 
 def openai_embeddings(model):
-    ensure_openai_api_key()
     model = model.lower() if model else "small"
     # https://platform.openai.com/docs/models/
     if "small" in model:
@@ -71,17 +97,367 @@ def openai_embeddings(model):
     else:
         raise ValueError(f"Unknown OpenAI model: {model}. "
                          "Please use 'small', 'large', or 'old'/'ada' variants.")
+    mode = cassette_mode()
+    if mode == "replay":
+        return CassetteEmbeddings(None, model, latency=replay_latency())
+    ensure_openai_api_key()
+    if mode == "record":
+        return CassetteEmbeddings(OpenAIEmbeddings(model=model), model, mode=mode)
     return OpenAIEmbeddings(model=model)
 
 
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper caching vectors on disk, by namespace (e.g. model name) and text hash.
+
+    The cache is shared by all the stores using the same file, and holds at most `max_entries` vectors:
+    the least recently used ones are evicted first.
+    """
+
+    def __init__(self, embeddings: Embeddings, namespace: str, db_file: str = str(FILE_EMBEDDINGS_CACHE), max_entries: int = 100_000):
+        self.__embeddings = embeddings
+        self.__namespace = namespace
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                namespace TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, text_hash)
+            )
+        """)
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self.__connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.__embeddings
+
+    @property
+    def namespace(self) -> str:
+        return self.__namespace
+
+    def __lookup(self, hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self.__lock:
+            for text_hash in hashes:
+                row = self.__connection.execute(
+                    "SELECT vector FROM embeddings WHERE namespace = ? AND text_hash = ?",
+                    (self.__namespace, text_hash),
+                ).fetchone()
+                if row is not None:
+                    found[text_hash] = array("f", row[0]).tolist()
+            with self.__connection:
+                self.__connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE namespace = ? AND text_hash = ?",
+                    [(time.time(), self.__namespace, text_hash) for text_hash in found],
+                )
+        return found
+
+    def __store(self, vectors: dict[str, list[float]]):
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO embeddings(namespace, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.__namespace, text_hash, array("f", vector).tobytes(), time.time()) for text_hash, vector in vectors.items()],
+            )
+            excess = self.__connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.__max_entries
+            if excess > 0:
+                self.__connection.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+
+    def __embed(self, texts: list[str], embed: callable) -> list[list[float]]:
+        hashes = [digest(text) for text in texts]
+        found = self.__lookup(list(dict.fromkeys(hashes)))
+        missing = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in found}
+        misses = sum(1 for text_hash in hashes if text_hash in missing)
+        with self.__lock:
+            self.hits += len(hashes) - misses
+            self.misses += misses
+        if missing:
+            computed = dict(zip(missing.keys(), embed(list(missing.values()))))
+            self.__store(computed)
+            found.update(computed)
+        return [found[text_hash] for text_hash in hashes]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.__embed(texts, self.__embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.__embed([text], lambda texts: [self.__embeddings.embed_query(texts[0])])[0]
+
+    def __str__(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.0%} hit ratio) in embeddings cache for {self.__namespace}"
+
+
+class SlidesVectorStore(SQLiteVec):
+    """SQLiteVec store of slides, keeping track of which slide is stored in which row, in a manifest table."""
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    @property
+    def manifest_table(self):
+        return f"{self._table}_manifest"
+
+    def create_table_if_not_exists(self) -> None:
+        super().create_table_if_not_exists()
+        self._connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.manifest_table}
+            (
+                source TEXT NOT NULL,
+                slide_index INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (source, slide_index)
+            )
+            ;
+            """
+        )
+        self._connection.commit()
+
+    def add_slides(self, slides: list[Slide], embeddings: list[list[float]]):
+        """Add already-embedded slides to the store, replacing previous versions of the same slides, in a single transaction."""
+        with self._connection:
+            for slide, embedding in zip(slides, embeddings):
+                previous = self._connection.execute(
+                    f"SELECT row FROM {self.manifest_table} WHERE source = ? AND slide_index = ?",
+                    (slide.source, slide.index),
+                ).fetchone()
+                if previous is not None:
+                    self.__delete_rows([previous["row"]])
+                row = self._connection.execute(
+                    f"INSERT INTO {self._table}(text, metadata, text_embedding) VALUES (?,?,?)",
+                    (slide.content, json.dumps(slide.metadata), serialize_f32(embedding)),
+                ).lastrowid
+                self._connection.execute(
+                    f"INSERT INTO {self.manifest_table}(source, slide_index, content_hash, row) VALUES (?,?,?,?)",
+                    (slide.source, slide.index, slide.content_hash, row),
+                )
+
+    def __delete_rows(self, rows: list[int]):
+        rows = [(row,) for row in rows]
+        self._connection.executemany(f"DELETE FROM {self._table}_vec WHERE rowid = ?", rows)
+        self._connection.executemany(f"DELETE FROM {self._table} WHERE rowid = ?", rows)
+        self._connection.executemany(f"DELETE FROM {self.manifest_table} WHERE row = ?", rows)
+
+    def delete_rows(self, rows: list[int]):
+        """Delete the given rows (and their manifest entries) from the store, in a single transaction."""
+        with self._connection:
+            self.__delete_rows(rows)
+
+    def manifest(self) -> dict[tuple[str, int], tuple[str, int]]:
+        """Map the (source, index) of each tracked slide to its content hash and row."""
+        return {
+            (row["source"], row["slide_index"]): (row["content_hash"], row["row"])
+            for row in self._connection.execute(f"SELECT * FROM {self.manifest_table}")
+        }
+
+    def untracked_rows(self):
+        """Iterate over the (row, text, metadata) of rows not tracked by the manifest, e.g. added before it existed."""
+        for row in self._connection.execute(
+                f"SELECT rowid, text, metadata FROM {self._table} WHERE rowid NOT IN (SELECT row FROM {self.manifest_table})"):
+            yield row["rowid"], row["text"], json.loads(row["metadata"]) or {}
+
+    def similarity_search_many(self, queries: list[str], k: int = 4) -> list[list[Document]]:
+        """Return the `k` documents most similar to each query, embedding all queries in a single batch."""
+        return [self.similarity_search_by_vector(embedding, k=k) for embedding in self._embedding.embed_documents(list(queries))]
+
+    def track(self, slides_and_rows: list[tuple[Slide, int]]):
+        """Record that each slide is stored in the corresponding row, in a single transaction."""
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {self.manifest_table}(source, slide_index, content_hash, row) VALUES (?,?,?,?)",
+                [(slide.source, slide.index, slide.content_hash, row) for slide, row in slides_and_rows],
+            )
+
+    def update_metadata(self, slides_and_rows: list[tuple[Slide, int]]) -> int:
+        """Refresh the metadata of the given rows, in a single transaction, and return how many rows actually changed."""
+        with self._connection:
+            changes = self._connection.total_changes
+            self._connection.executemany(
+                f"UPDATE {self._table} SET metadata = ? WHERE rowid = ? AND metadata IS NOT ?",
+                [(json.dumps(slide.metadata), row, json.dumps(slide.metadata)) for slide, row in slides_and_rows],
+            )
+            return self._connection.total_changes - changes
+
+
+def cached_embeddings(model: str = None, embeddings_cache_file: str = str(FILE_EMBEDDINGS_CACHE)):
+    """Embeddings cached in `embeddings_cache_file`, unless calls are recorded or replayed: then every text must
+    reach the cassette, which already serves as a cache on replay."""
+    embeddings = openai_embeddings(model)
+    if embeddings_cache_file and cassette_mode() == "live":
+        embeddings = CachedEmbeddings(embeddings, namespace=getattr(embeddings, "model", type(embeddings).__name__), db_file=embeddings_cache_file)
+    return embeddings
+
+
 def sqlite_vector_store(
         db_file: str = str(FILE_DB), 
         model: str = None, 
-        table_name: str = "se_slides"):
-    embeddings = openai_embeddings(model)
-    return SQLiteVec(
+        table_name: str = "se_slides",
+        embeddings_cache_file: str = str(FILE_EMBEDDINGS_CACHE)):
+    embeddings = cached_embeddings(model, embeddings_cache_file)
+    return SlidesVectorStore(
         db_file=db_file,
         embedding=embeddings,
         table=table_name,
         connection=None,
     )
+
+
+def numpy_vector_index(
+        db_file: str = str(FILE_DB),
+        model: str = None,
+        table_name: str = "se_slides",
+        embeddings_cache_file: str = str(FILE_EMBEDDINGS_CACHE)):
+    if not Path(db_file).exists():
+        sqlite_vector_store(db_file, model, table_name, embeddings_cache_file)
+    return NumpyVectorIndex(db_file, cached_embeddings(model, embeddings_cache_file), table_name)
+
+
+def batches(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@dataclass
+class FillReport:
+    slides: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def slides_per_second(self) -> float:
+        return self.slides / self.seconds if self.seconds else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"{self.slides} slides (~{self.tokens} tokens) in {self.seconds:.1f}s: "
+                f"{self.slides_per_second:.1f} slides/s, ~{self.tokens_per_second:.0f} tokens/s")
+
+
+def fill(vector_store: SlidesVectorStore, slides=None, batch_size: int = 64, max_workers: int = 4) -> FillReport:
+    """Embed `slides` (default: all slides) in batches, up to `max_workers` batches at a time, and add them to `vector_store`."""
+    if slides is None:
+        slides = all_slides()
+    embeddings = vector_store.embeddings
+    report = FillReport()
+    start = time.perf_counter()
+
+    def store(batch, future):
+        vector_store.add_slides(batch, future.result())
+        report.slides += len(batch)
+        report.tokens += sum(s.tokens_count for s in batch)
+        report.seconds = time.perf_counter() - start
+        print(f"# added {len(batch)} slides from {', '.join(sorted({s.source for s in batch}))} to vector store ({report})")
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        pending = deque()
+        for batch in batches(slides, max(1, batch_size)):
+            pending.append((batch, pool.submit(embeddings.embed_documents, [s.content for s in batch])))
+            if len(pending) > max_workers:
+                store(*pending.popleft())
+        while pending:
+            store(*pending.popleft())
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+@dataclass
+class SyncReport:
+    added: int = 0
+    removed: int = 0
+    relocated: int = 0
+    unchanged: int = 0
+    fill: FillReport = None
+
+    def __str__(self):
+        return (f"{self.added} slides added or changed, {self.removed} removed, "
+                f"{self.relocated} with updated lines, {self.unchanged} unchanged" +
+                (f" (embedded {self.fill})" if self.fill and self.fill.slides else ""))
+
+
+def sync(vector_store: SlidesVectorStore, slides=None, batch_size: int = 64, max_workers: int = 4) -> SyncReport:
+    """Make `vector_store` contain exactly `slides` (default: all slides), embedding only new or changed ones."""
+    if slides is None:
+        slides = all_slides()
+    slides = {(slide.source, slide.index): slide for slide in slides}
+    manifest = vector_store.manifest()
+    report = SyncReport()
+    stale_rows = []
+    adopted = []
+    for row, text, metadata in vector_store.untracked_rows():
+        key = (metadata.get("source"), metadata.get("index"))
+        slide = slides.get(key)
+        if slide is not None and key not in manifest and slide.content == text:
+            manifest[key] = (slide.content_hash, row)
+            adopted.append((slide, row))
+        else:
+            stale_rows.append(row)
+    vector_store.track(adopted)
+    to_embed = []
+    unchanged = []
+    for key, slide in slides.items():
+        content_hash, row = manifest.pop(key, (None, None))
+        if content_hash == slide.content_hash:
+            unchanged.append((slide, row))
+        else:
+            to_embed.append(slide)
+    stale_rows += [row for _, row in manifest.values()]
+    vector_store.delete_rows(stale_rows)
+    report.removed = len(stale_rows)
+    report.relocated = vector_store.update_metadata(unchanged)
+    report.unchanged = len(unchanged) - report.relocated
+    report.fill = fill(vector_store, to_embed, batch_size=batch_size, max_workers=max_workers)
+    report.added = len(to_embed)
+    return report
+
+
+def benchmark(db_file: str = str(FILE_DB), queries: int = 200, k: int = 5, table_name: str = "se_slides"):
+    """Compare SQLiteVec and NumpyVectorIndex on the same query vectors (slide embeddings), one query at a time and in batch."""
+    vector_store = sqlite_vector_store(db_file, table_name=table_name)
+    index = numpy_vector_index(db_file, table_name=table_name)
+    with sqlite3.connect(db_file) as connection:
+        vectors = [
+            array("f", blob).tolist()
+            for blob, in connection.execute(f"SELECT text_embedding FROM {table_name} ORDER BY rowid LIMIT ?", (queries,))
+        ]
+    if not vectors:
+        raise ValueError(f"No embeddings in {db_file}: fill the vector store first")
+    timings = {}
+    start = time.perf_counter()
+    expected = [vector_store.similarity_search_by_vector(vector, k=k) for vector in vectors]
+    timings["SQLiteVec, one query at a time"] = time.perf_counter() - start
+    start = time.perf_counter()
+    single = [index.similarity_search_by_vector(vector, k=k) for vector in vectors]
+    timings["NumPy, one query at a time"] = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = index.similarity_search_by_vectors(vectors, k=k)
+    timings["NumPy, all queries in batch"] = time.perf_counter() - start
+    agreement = sum(
+        [d.page_content for d in a] == [d.page_content for d in b] == [d.page_content for d in c]
+        for a, b, c in zip(expected, single, batched)
+    )
+    print(f"# benchmark: {len(vectors)} queries, k={k}, {len(index)} embeddings, {agreement}/{len(vectors)} identical results")
+    for name, seconds in timings.items():
+        print(f"# - {name}: {seconds:.3f}s ({len(vectors) / seconds:.0f} queries/s)")
+    return timings
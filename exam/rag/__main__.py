@@ -1,20 +1,30 @@
 from exam.rag import *
-import sys
+import argparse
 
 
-vector_store = sqlite_vector_store()
+parser = argparse.ArgumentParser(description="Fill or query the vector store of slides")
+parser.add_argument("--fill", action="store_true", help="Embed all slides and add them to the vector store")
+parser.add_argument("--sync", action="store_true", help="Only embed new or changed slides, and remove deleted ones from the vector store")
+parser.add_argument("--batch-size", type=int, default=64, help="Amount of slides to be embedded per request")
+parser.add_argument("--workers", "-j", type=int, default=4, help="Maximum amount of concurrent embedding requests")
+parser.add_argument("--benchmark", action="store_true", help="Compare SQLiteVec and NumPy retrieval over the slides in the vector store")
+parser.add_argument("--no-embeddings-cache", action="store_true", help="Do not cache embeddings on disk")
+args = parser.parse_args()
 
+if args.benchmark:
+    benchmark()
+    exit(0)
+
+vector_store = sqlite_vector_store(embeddings_cache_file=None if args.no_embeddings_cache else str(FILE_EMBEDDINGS_CACHE))
 
-if any(arg == "--fill" for arg in sys.argv):
-    print(f"# vector store created at {FILE_DB}")
 
-    for slide in all_slides():
-        vector_store.add_texts(
-            texts=[slide.content],
-            metadatas=[{"source": slide.source, "lines": slide.lines, "index": slide.index}],
-        )
-        print(f"# added {slide.lines_count} lines of text from {slide.source} (slide {slide.index}, lines {'%d-%s' % slide.lines}) to vector store")
-    print("# vector store filled successfully")
+if args.fill:
+    print(f"# vector store created at {FILE_DB}")
+    report = fill(vector_store, batch_size=args.batch_size, max_workers=args.workers)
+    print(f"# vector store filled successfully: {report}")
+elif args.sync:
+    report = sync(vector_store, batch_size=args.batch_size, max_workers=args.workers)
+    print(f"# vector store synchronised successfully: {report}")
 else:
     print(f"# vector store loaded successfully: it contains {vector_store.get_dimensionality()} embeddings.")
     while True:
@@ -29,4 +39,6 @@ else:
                 print("\t\t---")
         except (EOFError, KeyboardInterrupt):
             break
+if isinstance(vector_store.embeddings, CachedEmbeddings):
+    print(f"# {vector_store.embeddings}")
 print("# goodbye")
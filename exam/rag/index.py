@@ -0,0 +1,108 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from pathlib import Path
+import json
+import numpy as np
+import sqlite3
+
+
+class NumpyVectorIndex:
+    """Read-only, in-memory index of the embeddings in a SQLiteVec table, answering queries via matrix products.
+
+    Embeddings are copied once into a float32 matrix, saved in a sidecar `.npy` file next to the database,
+    and memory-mapped from there on later runs (the sidecar is rebuilt whenever the database is newer).
+    Ranking is by L2 distance, as in SQLiteVec.
+    """
+
+    def __init__(self, db_file: Path | str, embedding: Embeddings, table: str = "se_slides"):
+        self.__db_file = Path(db_file)
+        self.__embedding = embedding
+        self.__table = table
+        self.__file_matrix = self.__db_file.with_name(f"{self.__db_file.stem}.{table}.npy")
+        self.__file_rows = self.__db_file.with_name(f"{self.__db_file.stem}.{table}.rows.npy")
+        self.__matrix, self.__rows = self.__load()
+        self.__squared_norms = np.einsum("ij,ij->i", self.__matrix, self.__matrix)
+        self.__documents = None
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.__embedding
+
+    @property
+    def sidecar_file(self) -> Path:
+        return self.__file_matrix
+
+    def __is_sidecar_fresh(self) -> bool:
+        if not self.__file_matrix.exists() or not self.__file_rows.exists():
+            return False
+        sidecar_time = min(self.__file_matrix.stat().st_mtime, self.__file_rows.stat().st_mtime)
+        database_files = [self.__db_file, self.__db_file.with_name(self.__db_file.name + "-wal")]
+        return all(f.stat().st_mtime <= sidecar_time for f in database_files if f.exists())
+
+    def __load(self):
+        if not self.__is_sidecar_fresh():
+            self.__build_sidecar()
+        return np.load(self.__file_matrix, mmap_mode="r"), np.load(self.__file_rows)
+
+    def __build_sidecar(self):
+        with sqlite3.connect(self.__db_file) as connection:
+            rows = connection.execute(f"SELECT rowid, text_embedding FROM {self.__table} ORDER BY rowid").fetchall()
+        if rows:
+            matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        np.save(self.__file_matrix, np.ascontiguousarray(matrix, dtype=np.float32))
+        np.save(self.__file_rows, np.array([rowid for rowid, _ in rows], dtype=np.int64))
+        print(f"# built index of {len(rows)} embeddings in {self.__file_matrix}")
+
+    def __load_documents(self) -> list[Document]:
+        if self.__documents is None:
+            with sqlite3.connect(self.__db_file) as connection:
+                by_row = {
+                    rowid: Document(page_content=text, metadata=json.loads(metadata) or {})
+                    for rowid, text, metadata in connection.execute(f"SELECT rowid, text, metadata FROM {self.__table}")
+                }
+            self.__documents = [by_row[int(rowid)] for rowid in self.__rows]
+        return self.__documents
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def get_dimensionality(self) -> int:
+        return self.__matrix.shape[1] if len(self) else 0
+
+    def similarity_search_with_score_by_vectors(self, embeddings: list[list[float]], k: int = 4) -> list[list[tuple[Document, float]]]:
+        """Return the `k` documents closest to each of the given vectors, along with their L2 distance."""
+        if not len(self) or not len(embeddings):
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        # ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x, where ||q||^2 does not affect the ranking
+        distances = self.__squared_norms[np.newaxis, :] - 2 * (queries @ self.__matrix.T)
+        k = min(k, len(self))
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        documents = self.__load_documents()
+        results = []
+        for query, query_distances, indexes in zip(queries, distances, top):
+            indexes = indexes[np.argsort(query_distances[indexes], kind="stable")]
+            query_norm = float(query @ query)
+            results.append([
+                (documents[i], float(np.sqrt(max(query_distances[i] + query_norm, 0.0))))
+                for i in indexes
+            ])
+        return results
+
+    def similarity_search_by_vectors(self, embeddings: list[list[float]], k: int = 4) -> list[list[Document]]:
+        return [[doc for doc, _ in result] for result in self.similarity_search_with_score_by_vectors(embeddings, k)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4) -> list[Document]:
+        return self.similarity_search_by_vectors([embedding], k)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vectors([self.__embedding.embed_query(query)], k)[0]
+
+    def similarity_search(self, query: str, k: int = 4) -> list[Document]:
+        return self.similarity_search_by_vector(self.__embedding.embed_query(query), k)
+
+    def similarity_search_many(self, queries: list[str], k: int = 4) -> list[list[Document]]:
+        """Return the `k` documents most similar to each query, embedding all queries in a single batch."""
+        return self.similarity_search_by_vectors(self.__embedding.embed_documents(list(queries)), k)
@@ -1,14 +1,22 @@
 from pydantic import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate
-from exam import DIR_ROOT, Question
-from exam.openai import AIOracle
-from exam.rag import sqlite_vector_store
+from exam import DIR_ROOT, Question, digest
+from exam.openai import AIOracle, Metrics, CassetteMissError, INTERACTIVE
+from exam.rag import sqlite_vector_store, numpy_vector_index
 from yaml import safe_dump, safe_load
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import tempfile
+import time
 
 
 FILE_TEMPLATE = DIR_ROOT / "exam" / "solution" / "prompt-template.txt"
 DIR_SOLUTIONS = DIR_ROOT / "solutions"
 DIR_SOLUTIONS.mkdir(exist_ok=True)
+# read once, as the umask can only be read by changing it (which would race with threads creating files)
+UMASK = os.umask(0o022)
+os.umask(UMASK)
 
 
 class Answer(BaseModel):
@@ -68,6 +76,21 @@ def cache_file(question: Question):
     return DIR_SOLUTIONS / f"{question.id}.yaml"
 
 
+def input_hash(question: Question, model_name: str = None, model_provider: str = None) -> str:
+    return digest(TEMPLATE, question.text, model_name or "", model_provider or "")
+
+
+def _cached_input_hash(cached_answer: dict) -> str:
+    """Input hash of a cached answer: the stored one, or else the one of the prompt and model it records (as answers
+    predating input hashes do)."""
+    return cached_answer.get("input_hash") or digest(
+        cached_answer.get("prompt_template") or "",
+        cached_answer.get("question") or "",
+        cached_answer.get("model_name") or "",
+        cached_answer.get("model_provider") or "",
+    )
+
+
 def save_cache(
         question: Question,
         answer: Answer,
@@ -75,22 +98,40 @@ def save_cache(
         model_name: str = None,
         model_provider: str = None):
     cache_file_path = cache_file(question)
-    with open(cache_file_path, "w", encoding="utf-8") as f:
-        print(f"# saving answer to {cache_file_path}")
-        yaml = answer.model_dump()
-        yaml["question"] = question.text
-        yaml["helps"] = helps
-        yaml["id"] = question.id
-        if model_name:
-            yaml["model_name"] = model_name
-        if model_provider:
-            yaml["model_provider"] = model_provider
-        yaml["prompt_template"] = TEMPLATE
-        safe_dump(yaml, f, sort_keys=True, allow_unicode=True)
-        return yaml
-
-
-def load_cache(question: Question) -> Answer | None:
+    # write to a temporary file first, then rename it: the cache file is either complete or absent
+    fd, temp_file_path = tempfile.mkstemp(dir=cache_file_path.parent, prefix=f".{cache_file_path.name}.", suffix=".tmp")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            print(f"# saving answer to {cache_file_path}")
+            yaml = answer.model_dump()
+            yaml["question"] = question.text
+            yaml["helps"] = helps
+            yaml["id"] = question.id
+            if model_name:
+                yaml["model_name"] = model_name
+            if model_provider:
+                yaml["model_provider"] = model_provider
+            yaml["prompt_template"] = TEMPLATE
+            yaml["input_hash"] = input_hash(question, model_name, model_provider)
+            safe_dump(yaml, f, sort_keys=True, allow_unicode=True)
+        # temporary files are private: give the cache file the mode of the one it replaces, or the usual one
+        mode = cache_file_path.stat().st_mode & 0o777 if cache_file_path.exists() else 0o666 & ~UMASK
+        os.chmod(temp_file_path, mode)
+        os.replace(temp_file_path, cache_file_path)
+    except BaseException:
+        os.unlink(temp_file_path)
+        raise
+    return yaml
+
+
+def load_cache(question: Question, model_name: str = None, model_provider: str = None, helps: list[str] = None,
+               allow_stale: bool = False) -> Answer | None:
+    """Load the cached answer to `question`, unless it was generated from a different prompt, model, or course material.
+
+    When `model_name` or `model_provider` are not provided, the cached answer is accepted whatever model generated it;
+    when `helps` are not provided (or none were retrieved), it is accepted whatever course material it was generated from.
+    Stale answers are only reported, and loaded anyway, if `allow_stale`.
+    """
     cache_file_path = cache_file(question)
     if not cache_file_path.exists():
         return None
@@ -98,6 +139,19 @@ def load_cache(question: Question) -> Answer | None:
         print(f"# loading cached answer from {cache_file_path}")
         try:
             cached_answer = safe_load(f)
+            expected_hash = input_hash(
+                question,
+                model_name or cached_answer.get("model_name"),
+                model_provider or cached_answer.get("model_provider"),
+            )
+            if _cached_input_hash(cached_answer) != expected_hash:
+                print(f"# cached answer in {cache_file_path} is stale")
+                if not allow_stale:
+                    return None
+            elif helps and digest(*(cached_answer.get("helps") or [])) != digest(*helps):
+                print(f"# cached answer in {cache_file_path} is stale: course material changed")
+                if not allow_stale:
+                    return None
             return Answer(
                 should=cached_answer.get("should", []),
                 examples=cached_answer.get("examples", []),
@@ -110,23 +164,103 @@ def load_cache(question: Question) -> Answer | None:
             return None
 
 
+RETRIEVAL_BACKENDS = {
+    "sqlite": sqlite_vector_store,
+    "numpy": numpy_vector_index,
+}
+
+
 class SolutionProvider(AIOracle):
-    def __init__(self, model_name: str = None, model_provider: str = None):
-        super().__init__(model_name, model_provider, Answer)
-        self.__vector_store = sqlite_vector_store()
+    """Generates reference solutions, cached in `DIR_SOLUTIONS`.
+
+    If `check_material`, course material is retrieved before looking up the cache, and cached solutions generated
+    from different material are stale: as retrieval needs embeddings, and its ranking may change with the backend,
+    this is only done on request.
+    """
+
+    def __init__(self, model_name: str = None, model_provider: str = None, retrieval: str = "sqlite", metrics: Metrics = None,
+                 check_material: bool = False):
+        super().__init__(model_name, model_provider, Answer, metrics)
+        self.__check_material = check_material
+        if retrieval not in RETRIEVAL_BACKENDS:
+            raise ValueError(f"Unknown retrieval backend: {retrieval}. Please use one of {', '.join(RETRIEVAL_BACKENDS)}.")
+        self.__vector_store = RETRIEVAL_BACKENDS[retrieval]()
         self.__use_helps = self.__vector_store.get_dimensionality() > 0
 
+    def __load_cache(self, question: Question, helps: list[str] = None) -> Answer | None:
+        answer = load_cache(question, self.model_name, self.model_provider, helps)
+        self.metrics.record_cache("solutions", answer is not None, question.id)
+        return answer
+
+    def helps(self, questions: list[Question], max_helps=5) -> list[list[str]]:
+        """Course material relevant to each question, retrieved with a single embedding request."""
+        if not self.__use_helps or not questions:
+            return [[] for _ in questions]
+        documents = self.__vector_store.similarity_search_many([question.text for question in questions], k=max_helps)
+        return [[doc.page_content for doc in docs] for docs in documents]
+
+    def cached(self, questions: list[Question], max_helps=5) -> list[bool]:
+        """Whether each question has a valid cached solution (retrieving course material first, if `check_material`)."""
+        helps = self.helps(questions, max_helps) if self.__check_material else [None] * len(questions)
+        return [load_cache(question, self.model_name, self.model_provider, question_helps) is not None
+                for question, question_helps in zip(questions, helps)]
+
     def answer(self, question: Question, max_helps=5) -> Answer:
-        if (cache := load_cache(question)):
+        helps = None
+        if self.__check_material:
+            helps = self.helps([question], max_helps)[0]
+        if (cache := self.__load_cache(question, helps)):
             return cache
-        text = question.text
-        helps = []
-        if self.__use_helps:
-            helps = [doc.page_content for doc in self.__vector_store.similarity_search(text, k=max_helps)]
-        prompt = get_prompt(text, *helps)
-        result = self.llm.invoke(prompt)
+        if helps is None:
+            helps = self.helps([question], max_helps)[0]
+        return self.__solve(question, helps, priority=INTERACTIVE)
+
+    def iter_answers(self, questions: list[Question], max_helps=5, max_workers: int = 1, max_retries: int = 3):
+        """Yield (question, answer) pairs, in the same order of `questions`, as soon as each answer is available.
+
+        Course material for the uncached questions (or for all of them, if `check_material`) is retrieved with a single
+        embedding request, then up to `max_workers` questions are solved concurrently, each one retried up to `max_retries` times.
+        """
+        if self.__check_material:
+            helps = self.helps(questions, max_helps)
+            answers = [self.__load_cache(question, question_helps) for question, question_helps in zip(questions, helps)]
+            missing = [(question, question_helps) for question, question_helps, answer in zip(questions, helps, answers) if not answer]
+        else:
+            answers = [self.__load_cache(question) for question in questions]
+            missing = [question for question, answer in zip(questions, answers) if not answer]
+            missing = list(zip(missing, self.helps(missing, max_helps)))
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            solving = {
+                question.id: pool.submit(self.__solve_with_retries, question, question_helps, max_retries)
+                for question, question_helps in missing
+            }
+            try:
+                for question, answer in zip(questions, answers):
+                    yield question, answer or solving[question.id].result()
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def answer_many(self, questions: list[Question], max_helps=5, max_workers: int = 1, max_retries: int = 3) -> list[Answer]:
+        return [answer for _, answer in self.iter_answers(questions, max_helps, max_workers, max_retries)]
+
+    def __solve_with_retries(self, question: Question, helps: list[str], max_retries: int) -> Answer:
+        for attempt in range(max_retries + 1):
+            try:
+                return self.__solve(question, helps, attempt)
+            except CassetteMissError:
+                raise
+            except Exception as e:
+                if attempt >= max_retries:
+                    raise
+                delay = 2 ** attempt + random.random()
+                print(f"# error solving {question.id} (attempt {attempt + 1}/{max_retries + 1}): {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def __solve(self, question: Question, helps: list[str], attempt: int = 0, priority: int = None) -> Answer:
+        prompt = get_prompt(question.text, *helps)
+        result = self.invoke(prompt, question_id=question.id, attempt=attempt, priority=priority)
         if isinstance(result, Answer):
-            save_cache( question, result, helps, self.model_name, self.model_provider)
+            save_cache(question, result, helps, self.model_name, self.model_provider)
             return result
         else:
             raise ValueError(f"Expected {Answer.__name__}, got {type(result)}: {result}")
@@ -1,21 +1,48 @@
 from exam import *
-from exam.solution import SolutionProvider
-import sys
+from exam.solution import SolutionProvider, RETRIEVAL_BACKENDS
+from exam.openai import METRICS, SCHEDULER
+import argparse
 
 
+parser = argparse.ArgumentParser(description="Generate reference solutions via LLM")
+parser.add_argument("ids", nargs="*", help="IDs of the questions to be solved (default: all)")
+parser.add_argument("--retrieval", choices=RETRIEVAL_BACKENDS.keys(), default="sqlite", help="Backend for retrieving course material")
+parser.add_argument("--workers", "-j", type=int, default=1, help="Maximum amount of questions to be solved concurrently")
+parser.add_argument("--retries", type=int, default=3, help="Maximum amount of retries per question, upon errors")
+parser.add_argument("--check-material", action="store_true", help="Regenerate the cached solutions built from course material other than the one retrieved now")
+parser.add_argument("--dry-run", action="store_true", help="Only report how many LLM calls the generation would require")
+parser.add_argument("--metrics", type=str, default=None, help="Write a JSON summary of LLM calls and cache lookups to the given file")
+parser.add_argument("--trace", type=str, default=None, help="Append each LLM call and cache lookup, as a JSON line, to the given file")
+parser.add_argument("--rpm", type=float, default=None, help="Maximum amount of LLM requests per minute")
+parser.add_argument("--tpm", type=float, default=None, help="Maximum amount of LLM (prompt) tokens per minute")
+args = parser.parse_args()
+if args.rpm or args.tpm:
+    SCHEDULER.configure(args.rpm or SCHEDULER.requests_per_minute, args.tpm or SCHEDULER.tokens_per_minute)
+if args.trace:
+    METRICS.start_trace(args.trace)
+
 questions = QuestionsStore()
-llm = SolutionProvider()
 
-if len(sys.argv) > 1:
-    targets = [questions.question(id.strip()) for id in sys.argv[1:]]
+if args.ids:
+    targets = [questions.question(id.strip()) for id in args.ids]
 else:
     targets = questions.questions
 
-for q in targets:
+llm = SolutionProvider(retrieval=args.retrieval, check_material=args.check_material)
+
+if args.dry_run:
+    missing = [q for q, cached in zip(targets, llm.cached(targets)) if not cached]
+    print(f"# dry run: {len(targets)} questions to solve, {len(targets) - len(missing)} cached, {len(missing)} LLM calls needed")
+    exit(0)
+
+for q, a in llm.iter_answers(targets, max_workers=args.workers, max_retries=args.retries):
     print(q.id)
     print("\t", q.text)
-    a = llm.answer(q)
     print(a.pretty(indent=1))
     print("---")
-    
+
+METRICS.close()
+if args.metrics:
+    METRICS.write_summary(args.metrics)
+print(f"# metrics: {METRICS}")
 print("Done.")
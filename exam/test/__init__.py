@@ -1,10 +1,15 @@
 import argparse
+import random
 import sys
+from itertools import islice
 from exam import *
+from exam.test.variants import ExamSpace
 from z3 import Int, Solver, sat, Or, And
 
 
 VERBOSE = True
+ENGINES = ("z3", "dp", "random")
+FORMATS = ("text", "json", "moodle")
 
 
 def log(*args):
@@ -16,9 +21,15 @@ def create_arg_parser():
     parser = argparse.ArgumentParser(description='Test Generator')
     parser.add_argument("--questions-file", "-q", type=str, help='Path to questions .csv file', default=DEFAULT_QUESTIONS_FILE)
     parser.add_argument("--total-weight", "-w", type=int, help='Total weight of the test', default=9)
-    parser.add_argument("--categories", "-c", type=str, nargs='+', help='Categories to include in the test', action='append')
+    parser.add_argument("--categories", "-c", type=str, nargs='+', help='Categories to include in the test (in batch mode, repeat the flag to generate tests for several sets of categories)', action='append')
     parser.add_argument("--completely-different", "-d", action='store_true', help='Generate completely different tests (no repeated questions)')
     parser.add_argument("--max-grade", "-g", type=int, help='Maximum grade for the test', default=27)
+    parser.add_argument("--engine", "-e", choices=ENGINES, default="z3", help='Engine enumerating tests: z3 solver, dynamic programming, or uniform random sampling')
+    parser.add_argument("--seed", "-s", type=int, help='Seed of the random engine', default=None)
+    parser.add_argument("--count", "-n", type=int, help='Batch mode: generate this many tests (per set of categories) without asking anything', default=None)
+    parser.add_argument("--format", "-f", choices=FORMATS, default="text", help='Output format of batch mode (moodle writes one XML file per test)')
+    parser.add_argument("--output-dir", "-o", type=str, help='Directory of the XML files of the moodle format', default=".")
+    parser.add_argument("--workers", "-j", type=int, help='Amount of worker processes generating tests for different sets of categories (batch mode)', default=None)
     parser.add_argument("--verbose", "-v", action='store_true', help='Verbose mode')
     return parser
 
@@ -29,16 +40,27 @@ def parse_args(args = sys.argv[1:]):
 
 
 class TestGenerator:
+    """Enumerates tests with at least one question per target category, and weights summing to `total_weight`.
+
+    The z3 engine blocks each test found, and asks the solver for another one.
+    The dp engine enumerates the very same tests directly (see `ExamSpace`), in a different order.
+    The random engine draws distinct tests among the same ones, uniformly at random, reproducibly for a given `seed`.
+    """
+
     def __init__(self, db: QuestionsStore, total_weight: int, target_categories: set[Category],
-                 completely_different: bool = False):
+                 completely_different: bool = False, engine: str = "z3", seed: int = None):
         self.__db = db
         self.__total_weight = int(total_weight)
-        self.__target_categories = target_categories
-        for category in target_categories:
-            category = self.__db.category(category)
+        self.__target_categories = {self.__db.category(category) for category in target_categories}
+        for category in self.__target_categories:
             assert self.__db.category_size(category) > 0, f"Category {category} is empty"
             assert self.__db.category_weight(category) > 0, f"Category {category} has no weight"
-        self.__problem, self.__variables = self.__configure_problem()
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {', '.join(ENGINES)}")
+        self.__engine = engine
+        self.__seed = seed
+        if engine == "z3":
+            self.__problem, self.__variables = self.__configure_problem()
         self.__completely_different = completely_different
 
     def __configure_problem(self):
@@ -60,16 +82,43 @@ class TestGenerator:
         log(" + ".join(f'{q} * {w}' for q, (v, w) in variables.items()), "==", self.__total_weight)
         return solver, id_to_variables
 
+    @property
+    def count(self) -> int:
+        """Total amount of valid tests (regardless of --completely-different)."""
+        return ExamSpace(self.__db, self.__total_weight, self.__target_categories).count
+
     @property
     def solutions(self):
+        if self.__engine in ("dp", "random"):
+            return self.__dp_solutions(self.__engine == "random")
+        return self.__z3_solutions()
+
+    def __dp_solutions(self, randomly: bool):
+        if not self.__completely_different:
+            space = ExamSpace(self.__db, self.__total_weight, self.__target_categories)
+            log("tests found by dynamic programming:", space.count)
+            yield from space.samples(self.__seed) if randomly else space.solutions
+            return
+        used = set()
+        rng = random.Random(self.__seed)
+        while (space := ExamSpace(self.__db, self.__total_weight, self.__target_categories, used)).count:
+            yield (solution := space.sample(rng) if randomly else next(space.solutions))
+            used.update(q.id for q in solution.questions)
+            log("exclude questions:", ", ".join(q.id for q in solution.questions))
+
+    def __z3_solutions(self):
         while self.__compute_next_solution() == sat:
             yield (solution := self.__solution_to_questions())
             variables = self.__variables
             current_solution = {variables[q.id]: 1 for q in solution.questions}
+            if not self.__completely_different:
+                # block this very test only: adding questions weighing 0 to it makes other valid tests
+                chosen = {q.id for q in solution.questions}
+                current_solution.update({v: 0 for k, v in variables.items() if k not in chosen and self.__db.question(k).weight == 0})
             constraint = And if self.__completely_different else Or
             constraint_name = ' and ' if self.__completely_different else ' or '
             self.__problem.add(constraint([x != y for x, y in current_solution.items()]))
-            log("add constraint:", constraint_name.join([f'{q.id} != 1' for q in solution.questions]))
+            log("add constraint:", constraint_name.join([f'{x} != {y}' for x, y in current_solution.items()]))
 
     def __compute_next_solution(self):
         log("computing next solution...")
@@ -83,4 +132,28 @@ class TestGenerator:
             if value != 0:
                 questions.append(self.__db.question(question_id))
         return QuestionsStore(questions)
-    
\ No newline at end of file
+    
+
+def generate_tests(questions_file: str, total_weight: int, categories: list[str], completely_different: bool, engine: str,
+                   seed: int | None, count: int, max_grade: int, verbose: bool = False, queue=None, key=None) -> list[QuestionsStore]:
+    """Generate (up to) `count` tests, with weights scaled to `max_grade`: meant to be run in worker processes.
+
+    If a `queue` is given, tests are streamed through it as `(key, position, test)` items as soon as they are generated,
+    followed by `(key, None, None)` once done (even upon errors), and the returned list is empty.
+    """
+    global VERBOSE
+    VERBOSE = verbose
+    tests = []
+    try:
+        db = QuestionsStore(questions_file)
+        generator = TestGenerator(db, total_weight, set(categories), completely_different, engine, seed)
+        for position, test in enumerate(islice(generator.solutions, count), start=1):
+            test.total_weight = max_grade
+            if queue is None:
+                tests.append(test)
+            else:
+                queue.put((key, position, test))
+    finally:
+        if queue is not None:
+            queue.put((key, None, None))
+    return tests
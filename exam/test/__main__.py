@@ -1,38 +1,112 @@
 from exam import *
 import exam.test as etest
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import Manager
+import json
+import sys
 
 
-args = etest.parse_args()
-questions = QuestionsStore(args.questions_file)
-
-if not args.categories:
-    categories_by_index = dict()
-    categories = questions.categories
-    categories.sort(key=lambda x: questions.category_weight(x), reverse=True)
-    for i, category in enumerate(categories):
-        print(f"{i + 1})", category.name, f"({questions.category_size(category)} questions, total weight: {questions.category_weight(category)})")
-        categories_by_index[i + 1] = category
-    input_categories = input("Enter categories to include in the test (space separated): ")
-    selected_categories = []
-    for i in input_categories.split():
-        if "-" in i:
-            start, end = i.split("-")
-            selected_categories.extend(range(int(start), int(end) + 1))
-        else:
-            selected_categories.append(int(i))
-    indexes = map(int, selected_categories)
-    args.categories = {categories_by_index[i] for i in indexes}
-
-etest.VERBOSE = args.verbose
-generator = etest.TestGenerator(questions, args.total_weight, args.categories, args.completely_different)
-etest.log("generating test for topics", [c.name for c in args.categories])
-print("---")
-for test in generator.solutions:
-    test.total_weight = args.max_grade
-    print(test)
+def print_test(args, test: QuestionsStore, group: int, index: int, categories: list[str]):
+    """Print the `index`-th test for the `group`-th set of categories (both 1-based, so runs with a seed are reproducible)."""
+    if args.format == "json":
+        print(json.dumps({
+            "test": index,
+            "group": group,
+            "categories": categories,
+            "total_weight": test.total_weight,
+            "questions": [
+                {"id": q.id, "category": q.category.name, "weight": q.weight, "text": q.text}
+                for q in test.questions
+            ],
+        }, ensure_ascii=False))
+    elif args.format == "moodle":
+        path = Path(args.output_dir) / f"test-{group}-{index}.xml"
+        with open(path, "w", encoding="utf-8") as output:
+            test.write_xml(output)
+        print(path)
+    else:
+        print(f"# test {group}-{index}, for categories: {', '.join(categories) or '-'}")
+        print(test)
+        print("---")
+    sys.stdout.flush()
+
+
+def generate_in_batch(args, questions: QuestionsStore, category_sets: list[list[str]]):
+    if args.format == "moodle":
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    seeds = [None if args.seed is None else args.seed + i for i in range(len(category_sets))]
+    if len(category_sets) > 1 and args.workers != 1:
+        # tests are streamed as soon as workers generate them, so those of different groups may interleave
+        with Manager() as manager, ProcessPoolExecutor(max_workers=args.workers) as pool:
+            queue = manager.Queue()
+            futures = [
+                pool.submit(etest.generate_tests, str(args.questions_file), args.total_weight, categories,
+                            args.completely_different, args.engine, seed, args.count, args.max_grade, args.verbose, queue, group)
+                for group, (categories, seed) in enumerate(zip(category_sets, seeds), start=1)
+            ]
+            running = len(futures)
+            while running:
+                group, index, test = queue.get()
+                if test is None:
+                    running -= 1
+                else:
+                    print_test(args, test, group, index, category_sets[group - 1])
+            for future in futures:
+                future.result()
+        return
+    for group, (categories, seed) in enumerate(zip(category_sets, seeds), start=1):
+        generator = etest.TestGenerator(questions, args.total_weight, set(categories), args.completely_different, args.engine, seed)
+        for index, test in enumerate(islice(generator.solutions, args.count), start=1):
+            test.total_weight = args.max_grade
+            print_test(args, test, group, index, categories)
+
+
+def main():
+    args = etest.parse_args()
+    questions = QuestionsStore(args.questions_file)
+    etest.VERBOSE = args.verbose
+
+    if args.count is not None:
+        category_sets = [[questions.category(c).name for c in group] for group in args.categories or [[]]]
+        generate_in_batch(args, questions, category_sets)
+        return
+
+    if not args.categories:
+        categories_by_index = dict()
+        categories = sorted(questions.categories, key=lambda x: questions.category_weight(x), reverse=True)
+        for i, category in enumerate(categories):
+            print(f"{i + 1})", category.name, f"({questions.category_size(category)} questions, total weight: {questions.category_weight(category)})")
+            categories_by_index[i + 1] = category
+        input_categories = input("Enter categories to include in the test (space separated): ")
+        selected_categories = []
+        for i in input_categories.split():
+            if "-" in i:
+                start, end = i.split("-")
+                selected_categories.extend(range(int(start), int(end) + 1))
+            else:
+                selected_categories.append(int(i))
+        indexes = map(int, selected_categories)
+        args.categories = {categories_by_index[i] for i in indexes}
+    else:
+        args.categories = {questions.category(category) for group in args.categories for category in group}
+
+    generator = etest.TestGenerator(questions, args.total_weight, args.categories, args.completely_different, args.engine, args.seed)
+    etest.log("generating test for topics", [c.name for c in args.categories])
+    if args.engine != "z3":
+        # counting relies on the dynamic programming tables, which the z3 engine does not need
+        print(f"# {generator.count} valid tests")
     print("---")
-    try:
-        input("Press enter for next test")
-    except (EOFError, KeyboardInterrupt):
-        exit(0)
-print("No more tests")
+    for test in generator.solutions:
+        test.total_weight = args.max_grade
+        print(test)
+        print("---")
+        try:
+            input("Press enter for next test")
+        except (EOFError, KeyboardInterrupt):
+            exit(0)
+    print("No more tests")
+
+
+if __name__ == "__main__":
+    main()
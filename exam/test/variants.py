@@ -0,0 +1,164 @@
+from exam import QuestionsStore, Category, Question
+from fractions import Fraction
+from math import lcm
+import random
+
+
+def integer_weights(weights: list[float], total_weight: float) -> tuple[list[int], int]:
+    """Scale the given (non-negative) weights and total weight by the smallest factor making all of them integers."""
+    fractions = [Fraction(repr(float(w))) for w in weights]
+    total = Fraction(repr(float(total_weight)))
+    if any(f < 0 for f in fractions):
+        raise ValueError("Weights of questions must not be negative")
+    scale = lcm(total.denominator, *(f.denominator for f in fractions))
+    return [int(f * scale) for f in fractions], int(total * scale)
+
+
+class CategoryTable:
+    """Counts of the subsets of the questions in a category, by total (integer) weight, up to `max_weight`.
+
+    `counts[j][s]` is the amount of subsets of `questions[j:]` weighing exactly `s`
+    (each question weighing 0 doubles the counts, as it can be either included or not).
+    """
+
+    def __init__(self, questions: list[Question], weights: list[int], max_weight: int):
+        self.questions = questions
+        self.weights = weights
+        counts = [[0] * (max_weight + 1) for _ in range(len(questions) + 1)]
+        counts[-1][0] = 1
+        for j in range(len(questions) - 1, -1, -1):
+            current, following, weight = counts[j], counts[j + 1], weights[j]
+            for s in range(max_weight + 1):
+                current[s] = following[s] + (following[s - weight] if s >= weight else 0)
+        self.counts = counts
+        # subsets may only be complete once past the last question weighing 0
+        self.__last_weightless = max((j for j, weight in enumerate(weights) if weight == 0), default=-1)
+
+    def subsets(self, weight: int):
+        """Enumerate the subsets of questions weighing exactly `weight`, without ever visiting dead ends."""
+        if not self.counts[0][weight]:
+            return
+        # each entry is (next question, remaining weight, chosen questions as a linked list of (index, parent))
+        stack = [(0, weight, None)]
+        while stack:
+            j, remaining, chosen = stack.pop()
+            if remaining == 0 and j > self.__last_weightless:
+                subset = []
+                while chosen is not None:
+                    index, chosen = chosen
+                    subset.append(self.questions[index])
+                yield subset[::-1]
+                continue
+            if self.counts[j + 1][remaining]:
+                stack.append((j + 1, remaining, chosen))
+            if remaining >= self.weights[j] and self.counts[j + 1][remaining - self.weights[j]]:
+                stack.append((j + 1, remaining - self.weights[j], (j, chosen)))
+
+    def sample(self, weight: int, rng: random.Random, nonempty: bool = False) -> list[Question]:
+        """Draw one of the (non-empty, if `nonempty`) subsets of questions weighing exactly `weight`, uniformly at random."""
+        subset = self.__sample(weight, rng)
+        while nonempty and not subset:
+            # only possible for weight 0, where at least half of the subsets are non-empty
+            subset = self.__sample(weight, rng)
+        return subset
+
+    def __sample(self, weight: int, rng: random.Random) -> list[Question]:
+        subset, j = [], 0
+        while weight > 0 or j <= self.__last_weightless:
+            following, question_weight = self.counts[j + 1], self.weights[j]
+            including = following[weight - question_weight] if weight >= question_weight else 0
+            if rng.randrange(self.counts[j][weight]) < including:
+                subset.append(self.questions[j])
+                weight -= question_weight
+            j += 1
+        return subset
+
+
+class ExamSpace:
+    """All the exams with at least one question per target category, and weights summing exactly to `total_weight`.
+
+    Exams are counted via dynamic programming over the weight distributions of categories (of the non-empty subsets
+    of questions, for target categories), and enumerated
+    by following non-zero counts only: every step of the enumeration leads to a valid exam.
+    Questions in `excluded` (by ID) are not considered.
+    """
+
+    def __init__(self, db: QuestionsStore, total_weight: float, target_categories: set[Category], excluded: set[str] = frozenset()):
+        categories = db.categories
+        questions = [[q for q in db.questions_in_category(c) if q.id not in excluded] for c in categories]
+        weights, self.__total_weight = integer_weights([q.weight for qs in questions for q in qs], total_weight)
+        self.__required = [c in target_categories for c in categories]
+        self.__tables = []
+        for category_questions in questions:
+            category_weights, weights = weights[:len(category_questions)], weights[len(category_questions):]
+            self.__tables.append(CategoryTable(category_questions, category_weights, self.__total_weight))
+        # after[i][t] is the amount of ways categories i, i+1, ... can contribute weight t
+        # distributions[i][s] is the amount of subsets of category i weighing s (only non-empty ones, for target categories)
+        self.__distributions = []
+        for required, table in zip(self.__required, self.__tables):
+            distribution = list(table.counts[0])
+            if required:
+                distribution[0] -= 1
+            self.__distributions.append(distribution)
+        total = self.__total_weight
+        after = [[0] * (total + 1) for _ in range(len(categories) + 1)]
+        after[-1][0] = 1
+        for i in range(len(categories) - 1, -1, -1):
+            distribution, following = self.__distributions[i], after[i + 1]
+            for t in range(total + 1):
+                after[i][t] = sum(distribution[s] * following[t - s] for s in range(t + 1))
+        self.__after = after
+
+    @property
+    def count(self) -> int:
+        """Total amount of valid exams."""
+        return self.__after[0][self.__total_weight]
+
+    def __solutions(self, i: int, remaining: int, chosen: list[Question]):
+        if i == len(self.__tables):
+            yield chosen
+            return
+        table, distribution, following = self.__tables[i], self.__distributions[i], self.__after[i + 1]
+        for s in range(remaining + 1):
+            if distribution[s] and following[remaining - s]:
+                for subset in table.subsets(s):
+                    if subset or not self.__required[i]:
+                        yield from self.__solutions(i + 1, remaining - s, chosen + subset)
+
+    @property
+    def solutions(self):
+        """Enumerate all valid exams, in a deterministic order."""
+        if self.count:
+            for questions in self.__solutions(0, self.__total_weight, []):
+                yield QuestionsStore(questions)
+
+    def __sample(self, rng: random.Random) -> list[Question]:
+        remaining, questions = self.__total_weight, []
+        for i, table in enumerate(self.__tables):
+            distribution, following = self.__distributions[i], self.__after[i + 1]
+            r = rng.randrange(self.__after[i][remaining])
+            for s in range(remaining + 1):
+                r -= distribution[s] * following[remaining - s]
+                if r < 0:
+                    break
+            questions += table.sample(s, rng, nonempty=self.__required[i])
+            remaining -= s
+        return questions
+
+    def sample(self, rng: random.Random = None) -> QuestionsStore:
+        """Draw one valid exam, uniformly at random: each category gets a total weight with probability
+        proportional to the amount of exams having it, then one subset of questions of that weight."""
+        if not self.count:
+            raise ValueError("There are no valid exams")
+        return QuestionsStore(self.__sample(rng or random.Random()))
+
+    def samples(self, seed: int = None):
+        """Enumerate distinct valid exams, drawn uniformly at random (via `sample`), until all of them are drawn."""
+        rng = random.Random(seed)
+        drawn = set()
+        while len(drawn) < self.count:
+            questions = self.__sample(rng)
+            ids = frozenset(q.id for q in questions)
+            if ids not in drawn:
+                drawn.add(ids)
+                yield QuestionsStore(questions)